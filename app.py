@@ -1,18 +1,17 @@
-from shiny import App, Inputs, Outputs, Session, reactive, ui, render
+from shiny import App, Inputs, Outputs, Session, reactive, req, ui, render
+import bisect
+import threading
 from pathlib import Path
+from starlette.applications import Starlette
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.routing import Mount, Route
 from shinywidgets import output_widget, render_plotly, render_widget
-import plotly.graph_objects as go
 import shared
-import pandas as pd
-from ipyleaflet import TileLayer
-from modules import interface, plotly_theme
-from ipyleaflet import Map, basemaps, TileLayer, GeoJSON, WidgetControl, LayersControl, basemap_to_tiles, FullScreenControl
-from ipywidgets import HTML
-import requests
-
-# Shared local tile server URL
-TILE_SERVER_URL = "http://localhost:4000"
-#TILE_SERVER_URL = "https://amazonhydroviewer.onrender.com"
+# Plotly, pandas, ipyleaflet and requests are only imported on first use
+# (modules.ensemble_plot / modules.leaflet_map / inside modules.zonal and
+# modules.mapping) so a new worker can serve its first page quickly.
+from modules import anomaly, caching, export, interface, mapping, metrics, profiler, zonal
+
 # --- Setup page ui ---#
 
 # Build <head> contents
@@ -27,6 +26,11 @@ page_dependencies = ui.head_content(
     ui.tags.meta(name="apple-mobile-web-app-status-bar-style",
                  content="#000000"),
     ui.tags.meta(name="apple-mobile-web-app-capable", content="yes"),
+    # Caches release-versioned tiles and legends in the browser (www/sw.js)
+    ui.tags.script(
+        "if ('serviceWorker' in navigator) {"
+        f" navigator.serviceWorker.register('sw.js?release={shared.RELEASE_ID}'); }}"
+    ) if caching.VERSIONED else None,
 )
 
 page_header = ui.tags.div(
@@ -42,8 +46,17 @@ page_header = ui.tags.div(
     class_="header",
 )
 
-r = requests.get(shared.hydrobasins_lev05_url)
-geojson_data = r.json()
+def get_basins():
+    """Level 5 basins GeoJSON; the first call also starts the roll-ups and derived layers."""
+    geojson_data = mapping.get_geojson()
+    # Aggregate level 1-4 basins from level 5 in the background, once per process
+    zonal.start_rollup_build(geojson_data)
+    anomaly.start_build(geojson_data)
+    return geojson_data
+
+
+# Download the basins in the background instead of blocking startup
+threading.Thread(target=get_basins, daemon=True).start()
 
 # Define page content and interface structure
 app_ui = ui.page_fluid(
@@ -68,6 +81,8 @@ app_ui = ui.page_fluid(
                     ui.tags.h2(
                         "Zonal statistics \N{INBOX TRAY}")
                 ),
+                # Boxes come from precomputed quantiles unless members are requested
+                ui.input_switch("show_members", "Show ensemble members", value=False),
                 output_widget("boxplot"),
                 full_screen=False,
             ),
@@ -104,64 +119,72 @@ app_ui = ui.page_fluid(
 def server(input: Inputs, output: Outputs, session: Session):
     
     polygon = reactive.value('Waiting input')
+    frame_player = reactive.value(None)
+
+    metrics.inc('hydroviewer_sessions_total')
+    metrics.add_gauge('hydroviewer_active_sessions', 1)
+    session.on_ended(lambda: metrics.add_gauge('hydroviewer_active_sessions', -1))
+
+    # Per-session timeline of the reactive graph (HYDROVIEWER_PROFILE=<dir>)
+    profiler.start_session(session, dict(
+        {name: input[name] for name in (
+            'var_selector', 'depth_selector', 'layer_selector', 'forecast_category_selector',
+            'calender', 'time_slider', 'show_members')},
+        polygon=polygon,
+        frame_player=frame_player,
+    ))
 
     # Get time index 
     @reactive.calc
+    @profiler.profiled('get_time_steps')
     def get_time_steps():
         """Get time steps from tile server metadata endpoint."""
         try:
             variable = input.var_selector()
             if not variable:
                 return None
-            profile = int(input.depth_selector()) if variable in ["SoilTemp_inst", "SoilMoist_inst"] else 0
-
-            res = requests.get(
-                f"{TILE_SERVER_URL}/pyramid/time/{variable}",
-                params={"profile": profile},
-                timeout=10,
-            )
-            if res.status_code != 200:
-                return None
-            payload = res.json()
-            time_values = payload.get("time", [])
-            time_values = [t[0:-9]for t in time_values]
-            return time_values if time_values else None
+            profile = mapping.get_profile(variable, input.depth_selector)
+            return mapping.fetch_time_steps(variable, profile)
         except Exception:
             return None
 
     # Create a time slider to pick time-dimension
     @output
     @render.ui
+    @profiler.profiled('time_calender_selector')
     def time_calender_selector():  # create a time slider
         try:
             time = get_time_steps()
-            print(time)
             if time is None:
                 return ui.div("No dataset loaded or time variable missing.")
             if time is not None:  # check if time variable exists
-                # return ui.input_slider(
-                #     "time_slider",
-                #     "Select forecast lead time (in month)",
-                #     min=0,
-                #     max=len(time) - 1,
-                #     animate=True,
-                #     step=1,
-                #     value=0,
-                #     ticks=True,
-                # )
-                return ui.input_date(
-                    id="calender",
-                    label='',
-                    #label="Select forecast lead time (in month)",
-                    format='yyyy-MM-dd',
-                    startview='year',
-                    value=time[0],
-                    min=time[0],
-                    max=time[-1]
+                return ui.div(
+                    ui.input_date(
+                        id="calender",
+                        label='',
+                        #label="Select forecast lead time (in month)",
+                        format='yyyy-MM-dd',
+                        startview='year',
+                        value=time[0],
+                        min=time[0],
+                        max=time[-1]
+                    ),
+                    # Press play to step through every lead time
+                    ui.input_slider(
+                        "time_slider",
+                        "Forecast lead time (in month)",
+                        min=0,
+                        max=len(time) - 1,
+                        animate=ui.AnimationOptions(
+                            interval=shared.PLAYBACK_INTERVAL_MS, loop=True),
+                        step=1,
+                        value=0,
+                        ticks=True,
+                    ),
                 )
 
-        except Exception as e:
-            print(e)
+        except Exception:
+            metrics.inc('hydroviewer_errors_total', source='time_calender_selector')
             return ui.div("No dataset loaded or time variable missing.")
     
     # Display the current time index
@@ -188,245 +211,159 @@ def server(input: Inputs, output: Outputs, session: Session):
     #     else:
     #         return ('./static/probability_legend_default.png')
     
+    # Changes when a derived layer build starts or finishes (see modules/anomaly.py)
+    @reactive.poll(anomaly.status, 2)
+    def derived_layers_status():
+        return anomaly.status()
+
     @render_widget
+    @metrics.timed('hydroviewer_widget_render_seconds', widget='heatmap')
+    @profiler.profiled('heatmap')
     def heatmap():
-        """Update tile layer when tile URL changes"""
+        """Rebuild the map when the variable, layer, category or depth changes"""
         variable = input.var_selector()
         if not variable:
             return None
-        category = int(input.forecast_category_selector())
-        profile = int(input.depth_selector()) if variable in ["SoilTemp_inst", "SoilMoist_inst"] else 0
-        try:
-            time_id = input.calender()
-            if time_id is None:
-                return None
-        except Exception:
+        profile = mapping.get_profile(variable, input.depth_selector)
+        time_steps = get_time_steps()
+        if time_steps is None:
             return None
 
-        if variable in ['Tair_f_tavg', 'SoilTemp_inst']:
-            colormap = shared.colorscales_temp.get(input.forecast_category_selector())
-
-        else:
-           colormap = shared.colorscales.get(input.forecast_category_selector())
-
-        tile_url = (f'{TILE_SERVER_URL}/tiles/{variable}/{time_id}/{category}/'
-                    f'{{z}}/{{x}}/{{y}}.png?colormap={colormap}&profile={profile}'
-                    f'&mode=global&vmin=40&vmax=100'
-        )
+        from modules import leaflet_map
 
-        # tile_url, variable, category = build_tile_url()
-        print(f"{variable, category}")
-        print(tile_url)
-
-        forecast_layer = TileLayer(
-                url=tile_url,
-                name=f"{variable} - Category {category}",
-                opacity=0.8,
-                attribution='HydroViewer',
-                min_native_zoom=4,
-                max_native_zoom=9,
-                tms=True,
-        )
+        layer = input.layer_selector()
+        if layer in shared.DERIVED_LAYERS:
+            # Re-rendered when the layers finish computing
+            derived_layers_status()
+            # Precomputed basin values; changing time only restyles the basins
+            player = leaflet_map.LayerPlayer(
+                layer, variable, profile, time_steps, get_basins(),
+                on_select=polygon.set,
+            )
+            frame_player.set(player)
+            return player.map
 
-        polygon_layer = GeoJSON(
-            data=geojson_data,
-            style={
-                'color': 'grey',
-                'weight': 0.6,
-                'fillOpacity': 0,
-                'opacity': 1
-            },
-            hover_style={
-                'color': 'grey',
-                'weight': 0,
-                'fillOpacity': 0.4
-            },
-            name='HydroBasins @lvl 5'
-        )
-        #m.add_layer(polygon_layer)
-        #m.add_layer(forecast_layer)
-
-        m = Map(
-            center=[-7, -66],
-            zoom=4,
-            scroll_wheel_zoom=True,
-            max_zoom = 9,
-            basemap = basemap_to_tiles(basemaps.Stadia.AlidadeSmoothDark, 
-                                       "CartoDB Positron") #Stadia.AlidadeSmooth
+        category = int(input.forecast_category_selector())
+        # One preloaded tile layer per lead time; changing time only swaps frames
+        player = leaflet_map.FramePlayer(
+            variable, category, profile, time_steps, get_basins(),
+            on_select=polygon.set,
         )
+        frame_player.set(player)
+        return player.map
+
+    # Show the selected lead time on the map
+    @reactive.effect
+    @profiler.profiled('show_frame')
+    def show_frame():
+        player = frame_player()
+        req(player is not None)
+        player.show(input.time_slider())
+
+    # Keep the calendar and the playback slider on the same lead time
+    @reactive.effect
+    @profiler.profiled('calender_to_slider')
+    @reactive.event(input.calender)
+    def calender_to_slider():
+        time = get_time_steps()
+        req(time is not None and input.calender() is not None)
+        index = max(bisect.bisect_right(time, str(input.calender())) - 1, 0)
+        with reactive.isolate():
+            if input.time_slider() != index:
+                ui.update_slider("time_slider", value=index)
+
+    @reactive.effect
+    @profiler.profiled('slider_to_calender')
+    @reactive.event(input.time_slider)
+    def slider_to_calender():
+        time = get_time_steps()
+        req(time is not None)
+        value = time[min(input.time_slider(), len(time) - 1)]
+        with reactive.isolate():
+            if str(input.calender()) != value:
+                ui.update_date("calender", value=value)
+
+    # No download button until there is a basin to export
+    @render.ui
+    def export_button():
+        return interface.build_export_button(
+            input.export_scope() == 'basin' and polygon() == 'Waiting input')
+
+    # Stream the selected variable for the selected (or every) basin
+    @render.download(
+        filename=lambda: f"hydroviewer_{input.var_selector()}"
+                         f"{export.FORMATS[input.export_format()][1]}"
+    )
+    def export_download():
+        if input.export_scope() == 'basin':
+            req(polygon() != 'Waiting input')
+            pfaf_ids = [polygon()]
+        else:
+            pfaf_ids = [str(f['properties']['PFAF_ID']) for f in get_basins()['features']]
+        # Inputs are read here; the returned generator runs outside the reactive
+        # context. Shiny iterates sync generators on the event loop, so each chunk
+        # is produced in a worker thread instead
+        return iterate_in_threadpool(export.stream_export(
+            input.export_format(), pfaf_ids, [input.var_selector()], [input.depth_selector()]))
 
-        layercontrol = LayersControl(position='bottomright')
-        m.add_control(layercontrol)
-
-        m.add_layer(polygon_layer)
-        m.add_layer(forecast_layer)
-
-        # CSS styling to match app font
-        hover_style = """
-            font-family: 'Space Grotesk', sans-serif;
-            font-size: 14px;
-            padding: 8px 12px;
-            background: white;
-            border-radius: 4px;
-            box-shadow: 0 1px 4px rgba(0,0,0,0.2);
-        """
-        hover_info = HTML(value=f'<div style="{hover_style}"><b>Hover over a basin</b></div>')
-        hover_control = WidgetControl(widget=hover_info, position='topright')
-        m.add_control(hover_control)
-
-        # Add colorsale to map
-        colorbar_html_content = '''
-        <div style="background-color: white; 
-            border-radius: 4px;
-            padding: 8px 12px;
-            box-shadow: 0 2px 6px rgba(0,0,0,0.2);
-            max-width: 500px; height: auto;">'''
-        colorbar_html_content += f'''
-        <div style="margin-bottom: 15px;">
-            <div style="font-size: 11px; 
-                        font-weight: bold; 
-                        color: #333; 
-                        margin-bottom: 5px;
-                        text-align: center;">
-            </div>
-            <img src="{'https://raw.githubusercontent.com/blackteacatsu/AmazonHydroViewer/refs/heads/main/static/probability_legend_temp.png' 
-                       if variable in ['Tair_f_tavg', 'SoilTemp_inst'] 
-                       else 'https://raw.githubusercontent.com/blackteacatsu/AmazonHydroViewer/refs/heads/main/static/probability_legend_default.png'}" 
-                       style="width: 100%; height: auto;">
-        </div>
-        '''
-        #colorbar_html_content += '</div>'
-        legend_info = HTML(value=colorbar_html_content)
-        colorbar_control = WidgetControl(widget=legend_info, position='bottomleft')
-        m.add_control(colorbar_control)
-
-        def on_hover(event, feature, **kwargs):
-            pfaf_id = feature['properties'].get('PFAF_ID', 'N/A')
-            hover_info.value = f'<div style="{hover_style}"><b>Regional PFAF ID:</b> {pfaf_id}</div>'
-        
-        polygon_layer.on_hover(on_hover)
-
-        def on_polygon_click(event, feature, **kwargs):
-            if feature and "properties" in feature:
-                pfaf_id = feature["properties"].get("PFAF_ID")
-                if pfaf_id is not None:
-                    #print(pfaf_id)
-                    polygon.set(str(pfaf_id))
-                    print(polygon())
-
-        polygon_layer.on_click(on_polygon_click)
-        # print(f'Map Widget layer updated: # of layers currently loaded is {len(heatmapfig.layers)}')
-        # for layer in m.layers:
-        #   print(f'  - {layer.name}')
-        #m.add(FullScreenControl())
-        
-        return m
-    
-
+    # (basin, variable, soil profile, members) shown by the boxplot widget
+    boxplot_shown = {'key': None}
 
     # Build the boxplot figure which will display the zonal statistics
     @render_plotly
+    @metrics.timed('hydroviewer_figure_build_seconds', figure='boxplot')
+    @profiler.profiled('boxplot')
     def boxplot():
-        ensemblebox = go.Figure()
+        from modules import ensemble_plot
 
         # Initially display an empty figure with Brutalist styling
         if polygon() == "Waiting input":
-            ensemblebox.update_layout(
-                **plotly_theme.get_brutalist_layout(
-                    annotations=[
-                        plotly_theme.get_empty_state_annotation(
-                            "NO DATA SELECTED<br>CLICK ON A POLYGON TO VIEW STATISTICS"
-                        )
-                    ]
-                )
-            )
-            return ensemblebox
-
-        try:
-            zonal_stats_tab = pd.read_csv(
-                shared.ZONAL_FORECAST_PATH + polygon() + ".csv")
-            zonal_climatology_tab = pd.read_csv(
-                shared.ZONAL_CLIM_PATH + polygon() + ".csv"
-            )
-        except Exception as e:
-            ensemblebox.update_layout(
-                **plotly_theme.get_brutalist_layout(
-                    annotations=[
-                        plotly_theme.get_empty_state_annotation(
-                            f"ERROR LOADING DATA<br>{str(e)}"
-                        )
-                    ],
-                    height=420,
-                )
-            )
-            return ensemblebox
+            boxplot_shown['key'] = None
+            return ensemble_plot.build_empty_boxplot(
+                "NO DATA SELECTED<br>CLICK ON A POLYGON TO VIEW STATISTICS")
+
+        # Variable and depth changes are applied in place by update_boxplot
+        pfaf_id, members = polygon(), input.show_members()
+        with reactive.isolate():
+            var = input.var_selector()
+            key = (pfaf_id, var, mapping.get_profile(var, input.depth_selector), members)
+        boxplot_shown['key'] = key
+        return ensemble_plot.build_boxplot(
+            key[0], key[1], key[2], members=key[3])
+
+    # Switching variable or depth for the same basin patches the displayed
+    # figure, so only the changed trace values go over the websocket
+    @reactive.effect
+    @profiler.profiled('update_boxplot')
+    def update_boxplot():
+        from modules import ensemble_plot
+
+        # The depth is only read (and only matters) for soil variables
         var = input.var_selector()
-        depth = input.depth_selector()
-        var_col = (f"{var}_lvl_{depth}" if input.var_selector() in ["SoilTemp_inst", "SoilMoist_inst"] else var)
-
-        # Store climatology for each time step
-        climatology, time_labels = [], []
-        # print(zonal_climatology_tab) # Debugging check
-
-        for t in sorted(zonal_stats_tab["time"].unique()):
-            # print(var_col) # Debugging line
-            month = interface.format_date(t)
-            data_for_t = zonal_stats_tab.loc[zonal_stats_tab["time"]== t, var_col]
-            climatology_for_t = zonal_climatology_tab.loc[zonal_climatology_tab["month"] == int(month[-2:]), var_col] 
-            # print(f'printing extracted climatology at time {t}\ {climatology_for_t}') # Debugging line
-
-            # Save climatology for plotting later
-            climatology.append(float(climatology_for_t.iloc[0]))
-            time_labels.append(month)
-
-            # Add forecast data to box plot for this time step
-            ensemblebox.add_trace(
-                go.Box(
-                    y=data_for_t,
-                    x= [month] * len(data_for_t),
-                    name=month,  
-                    marker_color=None,  # Let Plotly pick auto color
-                    boxpoints=False,  
-                    hoverinfo='x + y',  # Show only y-axis values in hover
-                )
-            )
+        profile = mapping.get_profile(var, input.depth_selector)
+        widget = boxplot.widget
+        with reactive.isolate():
+            key = (polygon(), var, profile, input.show_members())
+        req(widget is not None and key[0] != "Waiting input" and key != boxplot_shown['key'])
 
-        # print(f'printing finished climatology values list {climatology}')
-        ensemblebox.add_trace(
-            go.Scatter(
-                y=climatology,
-                x=time_labels, 
-                mode="lines+markers",
-                name=f"(Climatology Mean)",
-                # marker_color=None,  # Let Plotly pick auto color
-                # boxmean=False,  # Optional: show mean as a line
-                line=dict(color="black", dash="dot"),
-                marker=dict(color="black", size=6),
-                hovertemplate='<b>Climatology</b><br>%{x}<br>Mean: %{y}<extra></extra>',
-            )
-        )
+        with metrics.timer('hydroviewer_figure_build_seconds', figure='boxplot_update'):
+            ensemble_plot.update_figure(widget, ensemble_plot.build_boxplot(
+                key[0], var, profile, members=key[3]))
+        boxplot_shown['key'] = key
 
-        # Apply Brutalist theme with custom title and axis labels
-        var_name = shared.CLIM_VAR_META.get(input.var_selector())['long_name'].upper()
-        var_unit = shared.CLIM_VAR_META.get(input.var_selector())['unit']
-        depth_label = shared.SOIL_VAR_PROFILE.get(int(input.depth_selector()))
-
-        ensemblebox.update_layout(
-            **plotly_theme.get_brutalist_layout(
-                title={
-                    'text': f"ENSEMBLE SPREAD: {var_name} | REGION {polygon()} | DEPTH {depth_label}",
-                },
-                xaxis={
-                    'title': {'text': 'TIME PERIOD'},
-                    'showgrid': False,
-                },
-                yaxis={
-                    'title': {'text': f"{var_name} ({var_unit})"},
-                },
-            )
-        )
 
-        return ensemblebox
+app = App(app_ui, server, static_assets={
+    "/": Path(__file__).parent / "www",
+    "/static": Path(__file__).parent / "static",
+})
+
+async def export_route(request):
+    return await export.export_endpoint(request, await run_in_threadpool(get_basins))
+
 
+# Extra HTTP endpoints served next to the Shiny app
+app = Starlette(routes=[Route("/export", export_route), Mount("/", app=app)])
+app = caching.CacheControlMiddleware(app)
 
-app = App(app_ui, server, static_assets=Path(__file__).parent / "www")
+# Metrics stay off the public app, on a localhost-only port
+metrics.start_server()
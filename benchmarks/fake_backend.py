@@ -0,0 +1,334 @@
+"""
+Local stand-in for the remote data backend and the tile server.
+
+Serves synthetic, deterministic data of realistic size on the same paths the
+app requests:
+
+    /geojson/basins.geojson                                  HydroBASINS polygons
+    /get_zonal_averages_forecast_csv/zonal_forecast_pfaf_<id>.csv
+    /get_zonal_averages_climatology_csv/zonal_climatology_pfaf_<id>.csv
+    /pyramid/time/<variable>                                 time axis JSON
+    /tiles/<variable>/<time>/<category>/<z>/<x>/<y>.png      256x256 PNG tiles
+
+Tile misses are "rendered" (with `render_ms` of CPU-free delay) through a
+`RenderPool`, like the tile backend should: concurrent requests for the same
+tile share one render, and when the render queue is saturated the parent
+tile is served instead (overzoom).
+
+Run it standalone with `python -m benchmarks.fake_backend --port 8765`, then
+point the app at it with the HYDROVIEWER_BACKEND_DIR, HYDROVIEWER_GEOJSON_URL
+and HYDROVIEWER_TILE_SERVER_URL environment variables (see `app_environment`).
+"""
+
+import argparse
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from modules.singleflight import RenderPool, overzoom_parent
+
+
+VARIABLES = ["Rainf_tavg", "Qair_f_tavg", "Qs_tavg", "Evap_tavg",
+             "Tair_f_tavg", "Streamflow_tavg"]
+SOIL_VARIABLES = ["SoilMoist_inst", "SoilTemp_inst"]
+SOIL_LEVELS = 4
+
+
+class FakeBackendConfig:
+    """
+    Size and latency knobs of the synthetic backend.
+
+    Parameters:
+        n_basins (int): Number of level 5 basins
+        vertices (int): Vertices per basin polygon
+        n_members (int): Ensemble members per time step
+        n_times (int): Forecast lead times
+        tile_kb (int): Approximate size of a tile in kilobytes
+        latency_ms (float): Delay added to every response
+        jitter_ms (float): Uniform random extra delay
+        render_ms (float): Time to render a tile that is not cached yet
+        render_workers (int): Concurrent tile renders
+        render_queue (int): Pending renders above which tiles are overzoomed
+        seed (int): Random seed for the synthetic data
+    """
+
+    def __init__(self, n_basins=150, vertices=400, n_members=12, n_times=6,
+                 tile_kb=30, latency_ms=0.0, jitter_ms=0.0, render_ms=0.0,
+                 render_workers=4, render_queue=64, seed=0):
+        self.n_basins = n_basins
+        self.vertices = vertices
+        self.n_members = n_members
+        self.n_times = n_times
+        self.tile_kb = tile_kb
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.render_ms = render_ms
+        self.render_workers = render_workers
+        self.render_queue = render_queue
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def pfaf_ids(n_basins):
+    """
+    Returns `n_basins` level 5 Pfafstetter codes sharing realistic prefixes.
+    """
+    ids = []
+    for i in range(n_basins):
+        # Spread the basins over level 3/4 parents like the Amazon's 62xxx codes
+        ids.append(str(62000 + (i // 90) * 100 + ((i // 9) % 10) * 10 + i % 9 + 1))
+    return ids
+
+
+def time_axis(n_times):
+    return [f"2025-{month:02d}-01" for month in range(1, n_times + 1)]
+
+
+def value_columns():
+    columns = list(VARIABLES)
+    for var in SOIL_VARIABLES:
+        columns += [f"{var}_lvl_{lvl}" for lvl in range(SOIL_LEVELS)]
+    return columns
+
+
+def build_geojson(config):
+    rng = random.Random(config.seed)
+    features = []
+    ids = pfaf_ids(config.n_basins)
+    columns = int(len(ids) ** 0.5) + 1
+    for i, pfaf_id in enumerate(ids):
+        # Rough, wiggly ~1 degree cells over the Amazon
+        lon0 = -78 + (i % columns) * 1.0
+        lat0 = -16 + (i // columns) * 1.0
+        ring = []
+        n = max(config.vertices // 4, 1)
+        for side in range(4):
+            for k in range(n):
+                f = k / n
+                x, y = [(f, 0), (1, f), (1 - f, 1), (0, 1 - f)][side]
+                ring.append([round(lon0 + x + rng.uniform(-0.02, 0.02), 5),
+                             round(lat0 + y + rng.uniform(-0.02, 0.02), 5)])
+        ring.append(ring[0])
+        features.append({
+            "type": "Feature",
+            "properties": {"PFAF_ID": int(pfaf_id),
+                           "SUB_AREA": round(rng.uniform(2000, 20000), 1)},
+            "geometry": {"type": "Polygon", "coordinates": [ring]},
+        })
+    return json.dumps({"type": "FeatureCollection", "features": features}).encode()
+
+
+def build_forecast_csv(pfaf_id, config):
+    rng = random.Random(f"{config.seed}-{pfaf_id}-forecast")
+    columns = value_columns()
+    lines = [",".join(["time"] + columns)]
+    for t in time_axis(config.n_times):
+        for _ in range(config.n_members):
+            values = [f"{rng.uniform(0, 10):.6f}" for _ in columns]
+            lines.append(",".join([f"{t} 00:00:00"] + values))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def build_climatology_csv(pfaf_id, config):
+    rng = random.Random(f"{config.seed}-{pfaf_id}-climatology")
+    columns = value_columns()
+    lines = [",".join(["month"] + columns)]
+    for month in range(1, 13):
+        values = [f"{rng.uniform(0, 10):.6f}" for _ in columns]
+        lines.append(",".join([str(month)] + values))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def build_png(size_kb, seed, width=256, height=256):
+    """
+    Encodes an RGBA PNG whose compressed size is roughly `size_kb`.
+    """
+    rng = random.Random(seed)
+    row_bytes = width * 4
+    # Random rows barely compress; flat rows almost vanish
+    noisy_rows = min(height, max(1, int(size_kb * 1024 / row_bytes)))
+    raw = bytearray()
+    flat = bytes([40, 90, 160, 200]) * width
+    for y in range(height):
+        raw.append(0)
+        raw += rng.randbytes(row_bytes) if y < noisy_rows else flat
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(bytes(raw), 6))
+            + chunk(b"IEND", b""))
+
+
+class FakeBackend:
+    """
+    Threaded HTTP server serving the synthetic backend.
+
+    Use as a context manager, or call `start()` / `stop()`.
+    """
+
+    _forecast_re = re.compile(r"^/get_zonal_averages_forecast_csv/zonal_forecast_pfaf_(\d+)\.csv$")
+    _clim_re = re.compile(r"^/get_zonal_averages_climatology_csv/zonal_climatology_pfaf_(\d+)\.csv$")
+    _time_re = re.compile(r"^/pyramid/time/(\w+)$")
+    _tile_re = re.compile(r"^/tiles/(\w+)/([\w-]+)/(\d)/(\d+)/(\d+)/(\d+)\.png$")
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or FakeBackendConfig()
+        self.geojson = build_geojson(self.config)
+        self.ids = set(pfaf_ids(self.config.n_basins))
+        self.tiles = [build_png(self.config.tile_kb, seed) for seed in range(8)]
+        self.requests = 0
+        self.renders = 0
+        self.render_pool = RenderPool('fake_tiles', max_workers=self.config.render_workers,
+                                      max_queue=self.config.render_queue)
+        self._tile_cache = {}
+        self._count_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def app_environment(self):
+        """
+        Returns the environment variables pointing the app at this backend.
+        """
+        return {
+            "HYDROVIEWER_BACKEND_DIR": self.url + "/",
+            "HYDROVIEWER_GEOJSON_URL": self.url + "/geojson/basins.geojson",
+            "HYDROVIEWER_TILE_SERVER_URL": self.url,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self.render_pool.shutdown()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def respond(self, path):
+        """
+        Returns (status, content type, body) for a request path.
+        """
+        path = path.split("?", 1)[0]
+        config = self.config
+        if path == "/geojson/basins.geojson":
+            return 200, "application/json", self.geojson
+        match = self._forecast_re.match(path)
+        if match and match.group(1) in self.ids:
+            return 200, "text/csv", build_forecast_csv(match.group(1), config)
+        match = self._clim_re.match(path)
+        if match and match.group(1) in self.ids:
+            return 200, "text/csv", build_climatology_csv(match.group(1), config)
+        match = self._time_re.match(path)
+        if match:
+            times = [f"{t}T00:00:00" for t in time_axis(config.n_times)]
+            return 200, "application/json", json.dumps({"time": times}).encode()
+        match = self._tile_re.match(path)
+        if match:
+            return 200, "image/png", self.tile(path, *(int(v) for v in match.groups()[3:]))
+        return 404, "text/plain", b"not found"
+
+    def tile(self, key, z, x, y):
+        """
+        Returns a cached tile, rendering it once however many requests wait for it.
+        """
+        cached = self._tile_cache.get(key)
+        if cached is not None:
+            return cached
+
+        def render():
+            with self._count_lock:
+                self.renders += 1
+            if self.config.render_ms:
+                time.sleep(self.config.render_ms / 1000)
+            payload = self.tiles[(z + x + y) % len(self.tiles)]
+            self._tile_cache[key] = payload
+            return payload
+
+        def shed():
+            # Stand-in for cropping and upscaling the parent tile
+            (pz, px, py), _ = overzoom_parent(z, x, y)
+            return self.tiles[(pz + px + py) % len(self.tiles)]
+
+        return self.render_pool.render(key, render, shed=shed)
+
+    def _handler(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with backend._count_lock:
+                    backend.requests += 1
+                delay = backend.config.latency_ms + random.uniform(0, backend.config.jitter_ms)
+                if delay > 0:
+                    time.sleep(delay / 1000)
+                status, content_type, body = backend.respond(self.path)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                # Like the tile server, so the service worker can cache tiles
+                self.send_header("Access-Control-Allow-Origin", "*")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--basins", type=int, default=150)
+    parser.add_argument("--members", type=int, default=12)
+    parser.add_argument("--times", type=int, default=6)
+    parser.add_argument("--tile-kb", type=int, default=30)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--render-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    config = FakeBackendConfig(
+        n_basins=args.basins, n_members=args.members, n_times=args.times,
+        tile_kb=args.tile_kb, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        render_ms=args.render_ms,
+    )
+    backend = FakeBackend(config, host=args.host, port=args.port)
+    for key, value in backend.app_environment().items():
+        print(f"export {key}={value}")
+    try:
+        backend._server.serve_forever()
+    except KeyboardInterrupt:
+        backend.stop()
+
+
+if __name__ == "__main__":
+    main()
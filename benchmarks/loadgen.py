@@ -0,0 +1,466 @@
+"""
+Simulated multi-session load generator for capacity planning.
+
+Opens N concurrent Shiny websocket sessions against a running app and replays
+an interaction script in each one (variable switch, category toggle, calendar
+change, playback, basin clicks). For every action it records the time until
+the server goes idle again and, like a browser would, sends back the inputs
+the server updated (calendar <-> slider) and fetches the map viewport tiles
+of any new forecast layer. Server CPU and memory come from the app's metrics
+server (localhost only, see modules/metrics.py), so start the app with
+HYDROVIEWER_METRICS=1 on the same host:
+
+    HYDROVIEWER_METRICS=1 shiny run app.py --port 8000
+    python -m benchmarks.loadgen http://127.0.0.1:8000 --sessions 100
+
+Scripts are JSON lists of steps, e.g.
+
+    [{"name": "variable", "inputs": {"var_selector": "Qs_tavg"}},
+     {"name": "click", "click": "first"},
+     {"name": "play", "play": 6},
+     {"name": "pause", "sleep": 2.0}]
+
+A `play` step advances the lead time slider that many frames, one action per
+frame, like pressing the slider's play button.
+
+Basin clicks are emulated with the ipywidgets comm messages shinywidgets
+exchanges with the browser.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import shared
+from modules import metrics
+from benchmarks.run_benchmarks import MAP_CENTER, MAP_ZOOM, git_commit, summarize, viewport_tiles
+
+
+OUTPUTS = ['heatmap', 'boxplot', 'time_calender_selector']
+
+INITIAL_INPUTS = {
+    'var_selector': 'Rainf_tavg',
+    'depth_selector': '0',
+    'forecast_category_selector': '0',
+}
+
+# Input ids as sent by their browser bindings (typed inputs carry a suffix)
+INPUT_KEYS = {'calender': 'calender:shiny.date'}
+
+# Round trips of server input updates answered by the browser per action
+MAX_ECHO_ROUNDS = 5
+
+# The app serves its metrics on a separate, localhost-only port
+DEFAULT_METRICS_URL = f'http://127.0.0.1:{metrics.PORT}/metrics'
+
+DEFAULT_SCRIPT = [
+    {'name': 'calendar', 'inputs': {'calender:shiny.date': '{time[0]}'}},
+    {'name': 'play', 'play': 6},
+    {'name': 'click_basin', 'click': 'first'},
+    {'name': 'category', 'inputs': {'forecast_category_selector': '2'}},
+    {'name': 'variable', 'inputs': {'var_selector': 'Tair_f_tavg'}},
+    {'name': 'calendar', 'inputs': {'calender:shiny.date': '{time[1]}'}},
+    {'name': 'click_basin', 'click': 'random'},
+    {'name': 'variable', 'inputs': {'var_selector': 'SoilMoist_inst'}},
+    {'name': 'depth', 'inputs': {'depth_selector': '2'}},
+    {'name': 'click_basin', 'click': 'first'},
+]
+
+
+class SessionStats:
+    """
+    Measurements shared by all simulated sessions.
+    """
+
+    def __init__(self):
+        self.latencies = {}      # action name -> [seconds]
+        self.tiles = {}          # action name -> [tile requests]
+        self.tile_latencies = []
+        self.errors = []
+
+    def record(self, action, seconds, tiles):
+        self.latencies.setdefault(action, []).append(seconds)
+        self.tiles.setdefault(action, []).append(tiles)
+
+    def report(self):
+        actions = {}
+        for action, durations in self.latencies.items():
+            tiles = self.tiles[action]
+            actions[action] = dict(summarize(durations),
+                                   tiles_per_action=round(sum(tiles) / len(tiles), 2))
+        return {
+            'actions': actions,
+            'tiles': summarize(self.tile_latencies) if self.tile_latencies else None,
+            'errors': len(self.errors),
+            'first_errors': self.errors[:5],
+        }
+
+
+class ShinySession:
+    """
+    One simulated browser tab speaking the Shiny websocket protocol.
+    """
+
+    def __init__(self, app_url, stats, fetch_tiles=True, timeout=60.0, seed=0):
+        self.app_url = app_url.rstrip('/')
+        self.stats = stats
+        self.fetch_tiles = fetch_tiles
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.ws = None
+        self.time_range = None    # (first, last) date offered by the calendar
+        self.slider_max = None    # last index of the lead time slider
+        self.inputs = {}          # input id -> value the simulated browser holds
+        self.echoes = {}          # inputs the server updated, to send back
+        self.geojson_comms = []   # comm ids of the basin layers
+        self.basin_ids = []
+        self.tile_urls = []       # forecast tile URL templates opened since the last action
+
+    async def connect(self):
+        import websockets
+
+        parts = urlsplit(self.app_url)
+        scheme = 'wss' if parts.scheme == 'https' else 'ws'
+        self.ws = await websockets.connect(
+            f'{scheme}://{parts.netloc}{parts.path}/websocket/', max_size=None)
+        init = dict(INITIAL_INPUTS)
+        init.update({
+            '.clientdata_url_protocol': parts.scheme + ':',
+            '.clientdata_url_hostname': parts.hostname,
+            '.clientdata_url_port': str(parts.port or ''),
+            '.clientdata_url_pathname': parts.path or '/',
+            '.clientdata_url_search': '',
+            '.clientdata_url_hash_initial': '',
+            '.clientdata_url_hash': '',
+            '.clientdata_pixelratio': 1,
+            '.clientdata_allowDataUriScheme': True,
+        })
+        for output_id in OUTPUTS:
+            init[f'.clientdata_output_{output_id}_hidden'] = False
+            init[f'.clientdata_output_{output_id}_width'] = 900
+            init[f'.clientdata_output_{output_id}_height'] = 600
+        self.inputs = {key.partition(':')[0]: value for key, value in init.items()}
+        await self.ws.send(json.dumps({'method': 'init', 'data': init}))
+        await self._until_idle()
+        await self._echo_updates()
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+    async def run_step(self, step):
+        if 'sleep' in step:
+            await asyncio.sleep(step['sleep'])
+            return
+        name = step.get('name', 'action')
+        if 'play' in step:
+            if self.slider_max is None:
+                self.stats.errors.append(f'{name}: no lead time slider to play')
+                return
+            interval = step.get('interval', shared.PLAYBACK_INTERVAL_MS / 1000)
+            for _ in range(step['play']):
+                # Looping playback, as with the slider's play button
+                frame = self.inputs.get('time_slider') or 0
+                frame = frame + 1 if frame < self.slider_max else 0
+                await self._act(name, self._send_inputs({'time_slider': frame}))
+                await asyncio.sleep(interval)
+            return
+        if 'click' in step:
+            if not self.geojson_comms or not self.basin_ids:
+                self.stats.errors.append(f'{name}: no basin layer to click')
+                return
+            pfaf_id = (self.basin_ids[0] if step['click'] == 'first'
+                       else self.rng.choice(self.basin_ids) if step['click'] == 'random'
+                       else step['click'])
+            await self._act(name, self._click(pfaf_id))
+        else:
+            inputs = {k: self._expand(v) for k, v in step.get('inputs', {}).items()}
+            await self._act(name, self._send_inputs(inputs))
+
+    async def _act(self, name, send):
+        """
+        Times one action: `send`, then every round trip until the server and browser settle.
+        """
+        self.tile_urls = []
+        start = time.perf_counter()
+        await send
+        await self._until_idle()
+        await self._echo_updates()
+        tiles = await self._load_tiles()
+        self.stats.record(name, time.perf_counter() - start, tiles)
+
+    async def _send_inputs(self, inputs):
+        for key, value in inputs.items():
+            self.inputs[key.partition(':')[0]] = value
+        await self.ws.send(json.dumps({'method': 'update', 'data': inputs}))
+
+    async def _echo_updates(self):
+        """
+        Sends back the inputs the server changed, as the browser bindings would.
+
+        E.g. a calendar change updates the slider, whose new value the browser
+        reports, which in turn runs the slider's observers.
+        """
+        for _ in range(MAX_ECHO_ROUNDS):
+            if not self.echoes:
+                return
+            echoes, self.echoes = self.echoes, {}
+            await self._send_inputs({INPUT_KEYS.get(k, k): v for k, v in echoes.items()})
+            await self._until_idle()
+        self.stats.errors.append('server kept updating inputs')
+
+    def _expand(self, value):
+        """
+        Replaces '{time[i]}' with the i-th monthly lead time offered by the calendar.
+        """
+        match = re.fullmatch(r'\{time\[(\d+)\]\}', value) if isinstance(value, str) else None
+        if match is None or self.time_range is None:
+            return value
+        first, last = self.time_range
+        year, month = int(first[:4]), int(first[5:7]) + int(match.group(1))
+        year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+        return min(f'{year:04d}-{month:02d}-{first[8:10]}', last)
+
+    async def _click(self, pfaf_id):
+        feature = {'type': 'Feature', 'properties': {'PFAF_ID': pfaf_id}}
+        message = {
+            'content': {
+                'comm_id': self.geojson_comms[-1],
+                'data': {'method': 'custom',
+                         'content': {'event': 'click', 'feature': feature,
+                                     'properties': feature['properties']}},
+            },
+            'buffers': [],
+        }
+        await self.ws.send(json.dumps({
+            'method': 'update',
+            'data': {'shinywidgets_comm_send': json.dumps(message)},
+        }))
+
+    async def _until_idle(self):
+        """
+        Consumes server messages until the server reports idle after being busy.
+        """
+        busy = False
+        deadline = time.perf_counter() + self.timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError('server did not go idle')
+            message = json.loads(await asyncio.wait_for(self.ws.recv(), remaining))
+            self._handle(message)
+            if message.get('busy') == 'busy':
+                busy = True
+            elif message.get('busy') == 'idle' and busy:
+                return
+
+    def _handle(self, message):
+        for key, value in (message.get('custom') or {}).items():
+            if 'comm_open' in key:
+                self._handle_comm_open(value)
+        for update in message.get('inputMessages') or []:
+            value = (update.get('message') or {}).get('value')
+            if value is not None and self.inputs.get(update['id']) != value:
+                self.echoes[update['id']] = value
+        selector = (message.get('values') or {}).get('time_calender_selector')
+        if selector:
+            html = json.dumps(selector)
+            first = re.search(r'data-min-date=\\?"(\d{4}-\d{2}-\d{2})', html)
+            last = re.search(r'data-max-date=\\?"(\d{4}-\d{2}-\d{2})', html)
+            if first and last:
+                self.time_range = (first.group(1), last.group(1))
+            # Newly rendered inputs report their initial value once bound
+            initial = re.search(r'data-initial-date=\\?"(\d{4}-\d{2}-\d{2})', html)
+            if initial:
+                self.echoes['calender'] = initial.group(1)
+            slider_max = re.search(r'data-max=\\?"(\d+)', html)
+            slider_from = re.search(r'data-from=\\?"(\d+)', html)
+            if slider_max and slider_from:
+                self.slider_max = int(slider_max.group(1))
+                self.echoes['time_slider'] = int(slider_from.group(1))
+
+    def _handle_comm_open(self, value):
+        if isinstance(value, str):
+            value = json.loads(value)
+        content = value.get('content', value)
+        state = (content.get('data') or {}).get('state') or {}
+        model = state.get('_model_name', '')
+        if model == 'LeafletGeoJSONModel':
+            self.geojson_comms.append(content.get('comm_id'))
+            features = (state.get('data') or {}).get('features') or []
+            self.basin_ids = [str(f['properties']['PFAF_ID']) for f in features
+                              if 'PFAF_ID' in f.get('properties', {})]
+        elif model == 'LeafletTileLayerModel' and '/tiles/' in state.get('url', ''):
+            self.tile_urls.append(state['url'])
+
+    async def _load_tiles(self):
+        if not self.fetch_tiles or not self.tile_urls:
+            return 0
+        urls = [
+            template.replace('{z}', str(z)).replace('{x}', str(x)).replace('{y}', str(y))
+            for template in self.tile_urls
+            for z, x, y in viewport_tiles(MAP_CENTER, MAP_ZOOM)
+        ]
+        durations = await asyncio.gather(*(asyncio.to_thread(_fetch, url) for url in urls))
+        for duration in durations:
+            if duration is None:
+                self.stats.errors.append('tile request failed')
+            else:
+                self.stats.tile_latencies.append(duration)
+        return len(urls)
+
+
+def _fetch(url):
+    import urllib.request
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=30) as res:
+            res.read()
+    except OSError:
+        return None
+    return time.perf_counter() - start
+
+
+def scrape_metrics(metrics_url):
+    """
+    Returns the unlabelled samples of the app's metrics endpoint, or {}.
+    """
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen(metrics_url, timeout=10) as res:
+            text = res.read().decode()
+    except OSError:
+        return {}
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#') and '{' not in line:
+            name, _, value = line.partition(' ')
+            samples[name] = float(value)
+    return samples
+
+
+async def run_session(app_url, script, stats, start_barrier, fetch_tiles, think_s, seed):
+    session = ShinySession(app_url, stats, fetch_tiles=fetch_tiles, seed=seed)
+    connected = False
+    try:
+        connect_start = time.perf_counter()
+        await session.connect()
+        stats.record('connect', time.perf_counter() - connect_start, 0)
+        connected = True
+    except Exception as e:
+        stats.errors.append(f'connect: {type(e).__name__}: {e}')
+
+    # All sessions start their scripts together, like a workshop room
+    await start_barrier.wait()
+    try:
+        if connected:
+            for step in script:
+                await session.run_step(step)
+                if think_s:
+                    await asyncio.sleep(session.rng.uniform(0, 2 * think_s))
+    except Exception as e:
+        stats.errors.append(f'{type(e).__name__}: {e}')
+    finally:
+        await session.close()
+
+
+async def run_load(app_url, n_sessions, script, ramp_s=0.0, fetch_tiles=True, think_s=0.0,
+                   metrics_url=DEFAULT_METRICS_URL):
+    """
+    Runs `n_sessions` concurrent sessions and returns the JSON-serializable report.
+    """
+    stats = SessionStats()
+    before = scrape_metrics(metrics_url)
+    start_barrier = _Barrier(n_sessions)
+
+    async def delayed(i):
+        await asyncio.sleep(ramp_s * i / max(n_sessions, 1))
+        await run_session(app_url, script, stats, start_barrier, fetch_tiles, think_s, i)
+
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(delayed(i)) for i in range(n_sessions)]
+    # Sample memory while every session is connected
+    await start_barrier.wait()
+    during = scrape_metrics(metrics_url)
+    await asyncio.gather(*tasks)
+    wall_time = time.perf_counter() - start
+    after = scrape_metrics(metrics_url)
+
+    report = stats.report()
+    report['server'] = _server_report(before, during, after, n_sessions, wall_time)
+    report['config'] = {'app_url': app_url, 'metrics_url': metrics_url, 'sessions': n_sessions, 'ramp_s': ramp_s,
+                        'think_s': think_s, 'fetch_tiles': fetch_tiles, 'steps': len(script)}
+    report['wall_time_s'] = round(wall_time, 3)
+    report['commit'] = git_commit()
+    return report
+
+
+def _server_report(before, during, after, n_sessions, wall_time):
+    if not before:
+        return None
+    cpu = after.get('process_cpu_seconds_total', 0) - before.get('process_cpu_seconds_total', 0)
+    rss_before = before.get('process_resident_memory_bytes')
+    rss_during = during.get('process_resident_memory_bytes')
+    return {
+        'cpu_seconds': round(cpu, 3),
+        'cpu_utilization': round(cpu / wall_time, 3) if wall_time else None,
+        'rss_before_mb': round(rss_before / 2**20, 1) if rss_before else None,
+        'rss_peak_sessions_mb': round(rss_during / 2**20, 1) if rss_during else None,
+        'memory_per_session_mb': (round((rss_during - rss_before) / 2**20 / n_sessions, 3)
+                                  if rss_before and rss_during and n_sessions else None),
+        'active_sessions_observed': during.get('hydroviewer_active_sessions'),
+    }
+
+
+class _Barrier:
+    """
+    asyncio barrier releasing waiters once `parties` sessions (plus the runner) arrived.
+    """
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.count = 0
+        self.event = asyncio.Event()
+
+    async def wait(self):
+        self.count += 1
+        if self.count >= self.parties + 1:
+            self.event.set()
+        await self.event.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('app_url', help='URL of the running app, e.g. http://127.0.0.1:8000')
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--ramp', type=float, default=5.0,
+                        help='Seconds over which sessions connect')
+    parser.add_argument('--think', type=float, default=0.5,
+                        help='Mean pause between actions, in seconds')
+    parser.add_argument('--script', help='JSON interaction script (default: workshop script)')
+    parser.add_argument('--no-tiles', action='store_true', help='Do not fetch map tiles')
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    parser.add_argument('--metrics-url', default=DEFAULT_METRICS_URL,
+                        help=f'Metrics endpoint of the app (default: {DEFAULT_METRICS_URL})')
+    args = parser.parse_args()
+
+    script = json.loads(Path(args.script).read_text()) if args.script else DEFAULT_SCRIPT
+    report = asyncio.run(run_load(
+        args.app_url, args.sessions, script, ramp_s=args.ramp,
+        fetch_tiles=not args.no_tiles, think_s=args.think, metrics_url=args.metrics_url,
+    ))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+Reproducible performance benchmarks against the local stand-in backend.
+
+Starts `FakeBackend`, points the app configuration at it, then drives the
+same functions the Shiny server calls (time steps, box plot, map) and the
+tile endpoint headlessly. Results are printed (or written) as JSON so runs can
+be compared across commits:
+
+    python -m benchmarks.run_benchmarks --latency-ms 40 --output bench.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks.fake_backend import FakeBackend, FakeBackendConfig, pfaf_ids
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Initial map view of the app (see modules/leaflet_map.py)
+MAP_CENTER = (-7, -66)
+MAP_ZOOM = 4
+
+
+def percentile(values, q):
+    """
+    Returns the `q`-th percentile (0-100) of `values`, by linear interpolation.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    pos = (len(ordered) - 1) * q / 100
+    lo, hi = math.floor(pos), math.ceil(pos)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+def summarize(durations, wall_time=None):
+    """
+    Returns latency percentiles (ms) and throughput (ops/s) of a run.
+    """
+    wall_time = wall_time if wall_time is not None else sum(durations)
+    return {
+        'n': len(durations),
+        'p50_ms': round(percentile(durations, 50) * 1000, 3),
+        'p95_ms': round(percentile(durations, 95) * 1000, 3),
+        'max_ms': round(max(durations) * 1000, 3),
+        'throughput_per_s': round(len(durations) / wall_time, 3) if wall_time else None,
+    }
+
+
+def measure(fn, repeat, setup=None):
+    """
+    Calls `fn` `repeat` times and summarizes the call durations.
+    """
+    durations = []
+    for i in range(repeat):
+        if setup is not None:
+            setup(i)
+        start = time.perf_counter()
+        fn(i)
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+def viewport_tiles(center, zoom, width_px=900, height_px=600, tms=True):
+    """
+    Returns the (z, x, y) tiles covering a map viewport.
+
+    Parameters:
+        center (tuple): (lat, lon) of the viewport center
+        zoom (int): Map zoom
+        width_px, height_px (int): Viewport size in pixels
+        tms (bool): Flip y like a TMS tile layer
+
+    Returns:
+        list: (z, x, y) tuples
+    """
+    lat, lon = center
+    n = 2 ** zoom
+    cx = (lon + 180) / 360 * n
+    cy = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n
+    half_w, half_h = width_px / 512, height_px / 512
+    tiles = []
+    for x in range(math.floor(cx - half_w), math.floor(cx + half_w) + 1):
+        for y in range(math.floor(cy - half_h), math.floor(cy + half_h) + 1):
+            if 0 <= y < n:
+                tiles.append((zoom, x % n, n - 1 - y if tms else y))
+    return tiles
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(config, repeat=20, tile_repeat=5, tile_concurrency=8):
+    """
+    Runs every benchmark and returns the JSON-serializable report.
+    """
+    with FakeBackend(config) as backend:
+        os.environ.update(backend.app_environment())
+        # Keep the last-known-good cache of these runs away from the app's
+        os.environ['HYDROVIEWER_CACHE_DIR'] = tempfile.mkdtemp(prefix='hydroviewer-bench-')
+        sys.path.insert(0, str(ROOT))
+        # Imported late so shared.py picks up the fake backend URLs
+        from modules import datasource, ensemble_plot, leaflet_map, mapping, quantiles, zonal
+
+        ids = sorted(pfaf_ids(config.n_basins))
+        rng = random.Random(config.seed)
+        results = {}
+
+        results['get_time_steps'] = measure(
+            lambda i: mapping.fetch_time_steps('Rainf_tavg', 0), repeat)
+        time_steps = mapping.fetch_time_steps('Rainf_tavg', 0)
+
+        start = time.perf_counter()
+        geojson_data = mapping.load_geojson()
+        results['load_geojson'] = summarize([time.perf_counter() - start])
+
+        def clear_caches(i):
+            zonal.clear_cache()
+            quantiles.clear_cache()
+            datasource.BACKEND.clear()
+
+        results['boxplot_cold'] = measure(
+            lambda i: ensemble_plot.build_boxplot(rng.choice(ids), 'Rainf_tavg', 0),
+            repeat, setup=clear_caches)
+        results['boxplot_warm'] = measure(
+            lambda i: ensemble_plot.build_boxplot(ids[0], 'SoilMoist_inst', i % 4),
+            repeat, setup=lambda i: quantiles.get_quantiles(ids[0]))
+        results['boxplot_members_warm'] = measure(
+            lambda i: ensemble_plot.build_boxplot(ids[0], 'SoilMoist_inst', i % 4, members=True),
+            repeat, setup=lambda i: zonal.get_zonal_tables(ids[0]))
+        # Figure JSON sent to the browser, with and without the members
+        results['boxplot_payload_bytes'] = {
+            'quantiles': len(ensemble_plot.build_boxplot(ids[0], 'Rainf_tavg', 0).to_json()),
+            'members': len(ensemble_plot.build_boxplot(
+                ids[0], 'Rainf_tavg', 0, members=True).to_json()),
+        }
+
+        def build_and_serialize(i):
+            m = leaflet_map.build_heatmap(
+                'Rainf_tavg', i % 3, 0, time_steps[i % len(time_steps)], geojson_data)
+            # What shinywidgets has to send to the browser
+            for widget in list(m.layers) + list(m.controls):
+                json.dumps(widget.get_state(), default=str)
+        results['heatmap'] = measure(build_and_serialize, repeat)
+
+        tile_urls = [
+            mapping.build_tile_url('Rainf_tavg', time_steps[0], 0, 0)
+                   .replace('{z}', str(z)).replace('{x}', str(x)).replace('{y}', str(y))
+            for z, x, y in viewport_tiles(MAP_CENTER, MAP_ZOOM)
+        ] * tile_repeat
+        results['tiles'] = _fetch_tiles(tile_urls, tile_concurrency)
+
+        backend_requests = backend.requests
+        backend_renders = backend.renders
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'config': dict(config.as_dict(), repeat=repeat, tile_repeat=tile_repeat,
+                       tile_concurrency=tile_concurrency),
+        'results': results,
+        'backend_requests': backend_requests,
+        'backend_tile_renders': backend_renders,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def _fetch_tiles(urls, concurrency):
+    import requests
+
+    session = requests.Session()
+
+    def fetch(url):
+        start = time.perf_counter()
+        session.get(url, timeout=30).raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        durations = list(pool.map(fetch, urls))
+    return summarize(durations, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--tile-repeat', type=int, default=5)
+    parser.add_argument('--tile-concurrency', type=int, default=8)
+    parser.add_argument('--basins', type=int, default=150)
+    parser.add_argument('--members', type=int, default=12)
+    parser.add_argument('--times', type=int, default=6)
+    parser.add_argument('--tile-kb', type=int, default=30)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--render-ms', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    config = FakeBackendConfig(
+        n_basins=args.basins, n_members=args.members, n_times=args.times,
+        tile_kb=args.tile_kb, latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms, render_ms=args.render_ms, seed=args.seed,
+    )
+    report = run(config, repeat=args.repeat, tile_repeat=args.tile_repeat,
+                 tile_concurrency=args.tile_concurrency)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
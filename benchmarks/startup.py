@@ -0,0 +1,153 @@
+"""
+Startup benchmark: import time of app.py and cold start to first UI byte.
+
+Both measurements run against the local fake backend, so network latency to
+GitHub does not leak into the numbers:
+
+1. `python -X importtime -c "import app"` in a fresh interpreter, reporting
+   the total and the slowest top-level imports.
+2. A fresh `uvicorn app:app` process, timed from spawn until the first byte
+   of `GET /` arrives.
+
+The run fails (exit code 1) when the cold start exceeds `--budget`:
+
+    python -m benchmarks.startup --budget 3.0 --output startup.json
+"""
+
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+from benchmarks.fake_backend import FakeBackend, FakeBackendConfig
+from benchmarks.run_benchmarks import ROOT, git_commit, percentile
+
+
+DEFAULT_BUDGET_S = 3.0
+
+_IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def measure_imports(env, top=15):
+    """
+    Returns the -X importtime breakdown of `import app`.
+
+    Parameters:
+        env (dict): Environment of the child interpreter
+        top (int): Number of slowest top-level imports to report
+
+    Returns:
+        dict: Total import time and the slowest top-level imports (ms)
+    """
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f'import app failed:\n{proc.stderr[-2000:]}')
+
+    top_level = []
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        # Top-level imports have a single space of indentation
+        if match and len(match.group(3)) == 1:
+            top_level.append((match.group(4), int(match.group(2)) / 1000))
+    top_level.sort(key=lambda item: item[1], reverse=True)
+    return {
+        'interpreter_wall_ms': round(wall * 1000, 1),
+        'app_cumulative_ms': dict(top_level).get('app'),
+        'slowest_imports_ms': {name: round(ms, 1) for name, ms in top_level[:top]},
+    }
+
+
+def measure_first_byte(env, timeout=60.0):
+    """
+    Starts the app in a new process and times the first byte of `GET /`.
+
+    Parameters:
+        env (dict): Environment of the app process
+        timeout (float): Seconds to wait for the app
+
+    Returns:
+        float: Seconds from spawn to the first response byte
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    url = f'http://127.0.0.1:{port}/'
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(port), '--log-level', 'warning'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f'app exited:\n{proc.stderr.read().decode()[-2000:]}')
+            try:
+                with urllib.request.urlopen(url, timeout=timeout) as res:
+                    res.read(1)
+                    return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.02)
+        raise TimeoutError(f'app did not answer within {timeout}s')
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def run(repeat=3, budget_s=DEFAULT_BUDGET_S):
+    """
+    Runs both measurements and returns the JSON-serializable report.
+    """
+    with FakeBackend(FakeBackendConfig()) as backend:
+        env = dict(os.environ, **backend.app_environment())
+        imports = measure_imports(env)
+        cold_starts = [measure_first_byte(env) for _ in range(repeat)]
+
+    p50 = percentile(cold_starts, 50)
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'imports': imports,
+        'cold_start_first_byte_s': {
+            'runs': [round(t, 3) for t in cold_starts],
+            'p50': round(p50, 3),
+            'max': round(max(cold_starts), 3),
+        },
+        'budget_s': budget_s,
+        'within_budget': p50 <= budget_s,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_S,
+                        help='Maximum p50 seconds from spawn to first UI byte')
+    parser.add_argument('--output', help='Write the JSON report to this file')
+    args = parser.parse_args()
+
+    report = run(repeat=args.repeat, budget_s=args.budget)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    print(text)
+    sys.exit(0 if report['within_budget'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""
+Derived forecast layers: anomalies against climatology and exceedance probability.
+
+The layers of every level 5 basin, variable column and lead time are computed
+together in one vectorized pass, in a background thread, so selecting a layer
+on the map costs a lookup instead of a computation. They are recomputed once
+for each newly published data plane release. Lookups never wait for a build:
+they return None meanwhile, and `status()` changes when a build finishes so
+the UI can poll it.
+
+Layers are only computed from a complete set of basins; while any basin
+cannot be loaded the build is retried, up to BUILD_ATTEMPTS times.
+
+    median_anomaly          ensemble median - climatology mean of the month
+    standardized_anomaly    median anomaly / ensemble standard deviation
+    exceedance_probability  fraction of members above the climatology mean
+
+The climatology tables only hold the monthly mean, so the anomaly is
+standardized by the ensemble spread rather than by the climatological one.
+"""
+
+import threading
+import time
+import warnings
+
+import shared
+from modules import interface, metrics, zonal
+
+
+# Builds before giving up, and the base delay between them (grows linearly)
+BUILD_ATTEMPTS = 5
+BUILD_RETRY_S = 60
+
+# release id (None without a data plane) -> layer name -> DataFrame indexed by
+# (PFAF_ID, 'YYYY-MM'), one column per variable column; only the latest release is kept
+_layers = {}
+
+# release id -> build thread, one per release
+_builds = {}
+_build_lock = threading.Lock()
+
+# Bumped whenever a build starts or ends, see `status`
+_generation = 0
+
+
+def start_build(geojson_data, release_id=None):
+    """
+    Computes the derived layers of a release in a background thread, once.
+
+    Parameters:
+        geojson_data (dict): Level 5 basins GeoJSON
+        release_id (str): Data plane release (default: the live one, if any)
+
+    Returns:
+        threading.Thread: The build thread
+    """
+    if release_id is None:
+        release_id = _current_release()[0]
+    with _build_lock:
+        thread = _builds.get(release_id)
+        if thread is None:
+            thread = _builds[release_id] = threading.Thread(
+                target=_build_with_retries, args=(release_id, geojson_data), daemon=True)
+            thread.start()
+    return thread
+
+
+def build_layers(geojson_data, release_id=None):
+    """
+    Loads the tables of every level 5 basin and computes the derived layers.
+
+    Nothing is stored if any basin cannot be loaded.
+
+    Parameters:
+        geojson_data (dict): Level 5 basins GeoJSON
+        release_id (str): Data plane release (None without a data plane)
+
+    Returns:
+        list: PFAF_IDs of the basins that could not be loaded
+    """
+    global _layers
+
+    tables, missing = {}, []
+    for feature in geojson_data['features']:
+        pfaf_id = str(feature['properties']['PFAF_ID'])
+        try:
+            # Only the layers are kept, not the members
+            tables[pfaf_id] = zonal.get_zonal_tables(pfaf_id, cache=False)
+        except Exception:
+            metrics.inc('hydroviewer_errors_total', source='anomaly')
+            missing.append(pfaf_id)
+    metrics.set_gauge('hydroviewer_anomaly_missing_basins', len(missing))
+    if missing:
+        # A map with holes would read as "no anomaly" there
+        return missing
+    layers = {}
+    if tables:
+        with metrics.timer('hydroviewer_parse_seconds', source='anomaly'):
+            layers = compute_layers(tables)
+    _layers = {release_id: layers}
+    return []
+
+
+def status():
+    """
+    Returns a value that changes whenever a build starts or finishes.
+
+    Cheap enough to poll from every session (see `reactive.poll`).
+    """
+    return _generation
+
+
+def is_building():
+    """
+    Returns True while a build (or its retries) is running.
+    """
+    return any(thread.is_alive() for thread in list(_builds.values()))
+
+
+def compute_layers(tables):
+    """
+    Computes every derived layer for a set of basins.
+
+    Parameters:
+        tables (dict): pfaf_id -> (forecast DataFrame, climatology DataFrame)
+
+    Returns:
+        dict: Layer name -> float32 DataFrame indexed by (PFAF_ID, 'YYYY-MM')
+    """
+    import numpy as np
+    import pandas as pd
+
+    forecast = pd.concat(
+        [f.assign(PFAF_ID=pfaf_id) for pfaf_id, (f, _) in tables.items()], ignore_index=True)
+    climatology = pd.concat(
+        [c.assign(PFAF_ID=pfaf_id) for pfaf_id, (_, c) in tables.items()], ignore_index=True)
+    forecast['time'] = forecast['time'].map(interface.format_date)
+    forecast['month'] = forecast['time'].str[-2:].astype(int)
+    columns = [c for c in forecast.columns
+               if c in climatology.columns and c not in ('PFAF_ID', 'month')]
+
+    # Climatology mean of the matching month, aligned with every forecast row
+    clim = (climatology.groupby(['PFAF_ID', 'month'])[columns].mean()
+                       .reindex(pd.MultiIndex.from_frame(forecast[['PFAF_ID', 'month']])))
+    values = forecast[columns].to_numpy(dtype=float)
+    clim_values = clim.to_numpy(dtype=float)
+
+    keys = [forecast['PFAF_ID'], forecast['time']]
+    median = forecast[columns].groupby(keys).median()
+    spread = forecast[columns].groupby(keys).std()
+    clim_mean = pd.DataFrame(clim_values, columns=columns).groupby(keys).first()
+    valid = ~(np.isnan(values) | np.isnan(clim_values))
+    above = pd.DataFrame((values > clim_values) & valid, columns=columns).groupby(keys).sum()
+    count = pd.DataFrame(valid, columns=columns).groupby(keys).sum()
+
+    anomaly = median - clim_mean
+    layers = {
+        'median_anomaly': anomaly,
+        'standardized_anomaly': anomaly / spread.replace(0, np.nan),
+        'exceedance_probability': above / count.replace(0, np.nan),
+    }
+    return {name: frame.rename_axis(['PFAF_ID', 'time']).astype('float32')
+            for name, frame in layers.items()}
+
+
+def get_layer(layer, column):
+    """
+    Returns a derived layer of one variable column, without waiting.
+
+    If the live data plane release has no layers yet, their build is started
+    in the background.
+
+    Parameters:
+        layer (str): One of shared.DERIVED_LAYERS
+        column (str): Zonal table column, e.g. 'SoilMoist_inst_lvl_0'
+
+    Returns:
+        DataFrame: Values indexed by PFAF_ID, one column per 'YYYY-MM' lead
+        time, or None if the layer is not available (yet)
+    """
+    if layer not in shared.DERIVED_LAYERS:
+        raise ValueError(f"Unknown layer {layer!r}, expected one of {sorted(shared.DERIVED_LAYERS)}")
+    release_id, plane = _current_release()
+    layers = _layers.get(release_id)
+    if layers is None:
+        if plane is not None:
+            # A new release went live since the layers were built
+            start_build(plane.geojson(), release_id)
+        return None
+    frame = layers.get(layer)
+    if frame is None or column not in frame.columns:
+        return None
+    return frame[column].unstack('time')
+
+
+def _current_release():
+    """
+    Returns the live data plane release as (release id, DataPlane), or (None, None).
+    """
+    from modules import dataplane
+
+    plane = dataplane.current()
+    return (plane.release_id, plane) if plane is not None else (None, None)
+
+
+def _build_with_retries(release_id, geojson_data):
+    global _generation
+
+    _generation += 1
+    try:
+        for attempt in range(1, BUILD_ATTEMPTS + 1):
+            try:
+                missing = build_layers(geojson_data, release_id)
+            except Exception as e:
+                missing = None
+                warnings.warn(f"Computing the derived layers failed: {e!r}", RuntimeWarning)
+                metrics.inc('hydroviewer_errors_total', source='anomaly')
+            if missing == []:
+                return
+            if missing:
+                warnings.warn(
+                    f"{len(missing)} of {len(geojson_data['features'])} basins could not be "
+                    f"loaded (e.g. {', '.join(missing[:5])}); derived layers are unavailable "
+                    f"(attempt {attempt} of {BUILD_ATTEMPTS})", RuntimeWarning)
+            if attempt < BUILD_ATTEMPTS:
+                time.sleep(BUILD_RETRY_S * attempt)
+    finally:
+        _generation += 1
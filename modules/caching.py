@@ -0,0 +1,85 @@
+"""
+HTTP caching of the app's static assets.
+
+Asset URLs carry the release id (`?v=<release>`, see `versioned`), so they can
+be cached by browsers for a year: a new release changes the URL instead of
+the content. Unversioned assets get a short max-age, and the service worker
+script is always revalidated so a new release reaches returning visitors.
+"""
+
+import shared
+
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+SHORT = 'public, max-age=3600'
+REVALIDATE = 'no-cache'
+
+# Extensions of the static assets served from www/ and static/
+STATIC_SUFFIXES = ('.js', '.css', '.png', '.ico', '.svg', '.json', '.geojson')
+
+# Without an explicit release id, nothing can be assumed immutable
+VERSIONED = shared.RELEASE_ID != 'dev'
+
+
+def versioned(url):
+    """
+    Appends the release id to an asset URL.
+
+    Parameters:
+        url (str): Asset URL
+
+    Returns:
+        str: URL with a `v=<release>` query parameter
+    """
+    return f"{url}{'&' if '?' in url else '?'}v={shared.RELEASE_ID}"
+
+
+def cache_control(path, query_string=b''):
+    """
+    Returns the Cache-Control value of a request, or None to leave it unset.
+
+    Parameters:
+        path (str): Request path
+        query_string (bytes): Raw query string
+
+    Returns:
+        str: Header value
+    """
+    if path.endswith('/sw.js'):
+        return REVALIDATE
+    if not path.endswith(STATIC_SUFFIXES):
+        return None
+    if VERSIONED and f'v={shared.RELEASE_ID}'.encode() in query_string.split(b'&'):
+        return IMMUTABLE
+    return SHORT
+
+
+class CacheControlMiddleware:
+    """
+    ASGI middleware setting Cache-Control on successful static asset responses.
+
+    Websockets and other requests pass through untouched.
+
+    Parameters:
+        app: ASGI app to wrap
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] not in ('GET', 'HEAD'):
+            return await self.app(scope, receive, send)
+        value = cache_control(scope['path'], scope.get('query_string', b''))
+        if value is None:
+            return await self.app(scope, receive, send)
+
+        async def send_with_header(message):
+            if message['type'] == 'http.response.start' and message['status'] in (200, 304):
+                headers = [(k, v) for k, v in message.get('headers', [])
+                           if k.lower() != b'cache-control']
+                headers.append((b'cache-control', value.encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_header)
@@ -0,0 +1,341 @@
+"""
+Read-only data plane shared by all worker processes.
+
+A loader process publishes a release once: zonal tables of every basin
+(levels 1-5), simplified basin geometry and the time axis are written as
+.npy files under a directory that lives in shared memory (/dev/shm by
+default). Workers memory-map them read-only, so every worker reads the same
+physical pages and memory stays flat as workers are added.
+
+Layout of a release directory:
+
+    manifest.json             release id, column names, basin count
+    basin_ids.npy             (n_basins,) int64 Pfafstetter codes, sorted
+    time_axis.npy             (n_times,) 'YYYY-MM-DD' strings
+    forecast_values.npy       (n_rows, n_columns) float32
+    forecast_time.npy         (n_rows,) int16 index into time_axis
+    forecast_offsets.npy      (n_basins + 1,) int64 row ranges per basin
+    climatology_values.npy    (n_rows, n_columns) float32
+    climatology_month.npy     (n_rows,) int8
+    climatology_offsets.npy   (n_basins + 1,) int64
+    quantile_values.npy       (n_rows, n_columns, n_stats) float32 ensemble statistics
+    quantile_time.npy         (n_rows,) int16 index into time_axis
+    quantile_offsets.npy      (n_basins + 1,) int64
+    geometry.json             simplified level 5 GeoJSON
+
+`<root>/CURRENT` names the live release; publishing a new release swaps it
+atomically and workers re-attach on their next lookup.
+
+    python -m modules.dataplane publish --release 2025-01
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from modules import metrics
+
+
+DEFAULT_ROOT = '/dev/shm/hydroviewer' if os.path.isdir('/dev/shm') else None
+ROOT = os.environ.get('HYDROVIEWER_DATA_PLANE', DEFAULT_ROOT)
+
+# Seconds between checks for a newly published release
+REFRESH_INTERVAL_S = 10.0
+
+# Decimal places kept in the published geometry (~11 m)
+GEOMETRY_PRECISION = 4
+
+_lock = threading.Lock()
+_plane = None
+_checked_at = 0.0
+
+
+class DataPlane:
+    """
+    One attached (memory-mapped) release.
+
+    Parameters:
+        path (Path): Release directory
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.manifest = json.loads((self.path / 'manifest.json').read_text())
+        self.release_id = self.manifest['release_id']
+        self.columns = self.manifest['columns']
+        self.arrays = {
+            f.stem: np.load(f, mmap_mode='r') for f in self.path.glob('*.npy')
+        }
+        self.basin_ids = self.arrays['basin_ids']
+        self.time_axis = np.asarray(self.arrays['time_axis'])
+        self._geojson = None
+
+    def _basin_index(self, pfaf_id):
+        i = int(np.searchsorted(self.basin_ids, int(pfaf_id)))
+        if i < len(self.basin_ids) and self.basin_ids[i] == int(pfaf_id):
+            return i
+        return None
+
+    def has_basin(self, pfaf_id):
+        return self._basin_index(pfaf_id) is not None
+
+    def tables(self, pfaf_id):
+        """
+        Returns the forecast and climatology tables of a basin.
+
+        The value columns are views on the shared pages, not copies.
+
+        Parameters:
+            pfaf_id (str or int): Pfafstetter code
+
+        Returns:
+            tuple: (forecast DataFrame, climatology DataFrame)
+        """
+        import pandas as pd
+
+        i = self._basin_index(pfaf_id)
+        if i is None:
+            raise KeyError(f"Basin {pfaf_id} is not in release {self.release_id}")
+        a, b = self.arrays['forecast_offsets'][i:i + 2]
+        forecast = pd.DataFrame(self.arrays['forecast_values'][a:b], columns=self.columns, copy=False)
+        forecast.insert(0, 'time', self.time_axis[self.arrays['forecast_time'][a:b]])
+        a, b = self.arrays['climatology_offsets'][i:i + 2]
+        climatology = pd.DataFrame(self.arrays['climatology_values'][a:b], columns=self.columns, copy=False)
+        climatology.insert(0, 'month', self.arrays['climatology_month'][a:b].astype(int))
+        return forecast, climatology
+
+    def has_quantiles(self, pfaf_id):
+        return 'quantile_values' in self.arrays and self.has_basin(pfaf_id)
+
+    def quantiles(self, pfaf_id):
+        """
+        Returns the precomputed ensemble statistics of a basin.
+
+        Parameters:
+            pfaf_id (str or int): Pfafstetter code
+
+        Returns:
+            tuple: ('YYYY-MM-DD' time steps, view of shape (times, columns, STATS))
+        """
+        i = self._basin_index(pfaf_id)
+        if i is None:
+            raise KeyError(f"Basin {pfaf_id} is not in release {self.release_id}")
+        a, b = self.arrays['quantile_offsets'][i:i + 2]
+        times = list(self.time_axis[self.arrays['quantile_time'][a:b]])
+        return times, self.arrays['quantile_values'][a:b]
+
+    def geojson(self):
+        """
+        Returns the simplified level 5 GeoJSON.
+
+        Map widgets need Python objects, so it is parsed once per worker.
+        """
+        if self._geojson is None:
+            self._geojson = json.loads((self.path / 'geometry.json').read_bytes())
+        return self._geojson
+
+
+def current():
+    """
+    Returns the attached live release, or None if no data plane is published.
+
+    Re-attaches when a new release has been published since the last check.
+    If the new release cannot be attached (e.g. it was pruned or is
+    incomplete), the previous one stays in use and the attach is retried at
+    the next check.
+    """
+    global _plane, _checked_at
+    if ROOT is None:
+        return None
+    now = time.monotonic()
+    if now - _checked_at < REFRESH_INTERVAL_S:
+        return _plane
+    with _lock:
+        _checked_at = now
+        try:
+            release_id = (Path(ROOT) / 'CURRENT').read_text().strip()
+        except OSError:
+            _plane = None
+            return None
+        if _plane is None or _plane.release_id != release_id:
+            try:
+                _plane = DataPlane(Path(ROOT) / release_id)
+            except (OSError, ValueError, KeyError) as e:
+                metrics.inc('hydroviewer_errors_total', source='dataplane')
+                warnings.warn(f"Cannot attach data plane release {release_id!r}: {e!r}; "
+                              f"keeping {_plane.release_id if _plane else None!r}",
+                              RuntimeWarning)
+        return _plane
+
+
+def publish(root, release_id, tables, geojson_data, keep=2):
+    """
+    Writes a release and makes it the live one.
+
+    Parameters:
+        root (str or Path): Data plane directory
+        release_id (str): Name of the release
+        tables (dict): pfaf_id -> (forecast DataFrame, climatology DataFrame)
+        geojson_data (dict): Level 5 basins GeoJSON
+        keep (int): Number of releases to keep on disk
+
+    Returns:
+        Path: Directory of the published release
+
+    Raises:
+        ValueError: If `tables` is empty
+    """
+    if not tables:
+        raise ValueError(f"Release {release_id} has no basins to publish")
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    tmp = root / f'.{release_id}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+
+    ids = sorted(tables, key=int)
+    columns = sorted({
+        c for forecast, _ in tables.values() for c in forecast.columns if c != 'time'
+    })
+    time_axis = sorted({
+        str(t)[:10] for forecast, _ in tables.values() for t in forecast['time'].unique()
+    })
+    time_index = {t: i for i, t in enumerate(time_axis)}
+
+    forecasts = [tables[i][0] for i in ids]
+    climatologies = [tables[i][1] for i in ids]
+    _save(tmp, 'basin_ids', np.array([int(i) for i in ids], dtype=np.int64))
+    _save(tmp, 'time_axis', np.array(time_axis, dtype='U10'))
+    _save(tmp, 'forecast_values', _stack(forecasts, columns))
+    _save(tmp, 'forecast_time', np.concatenate([
+        f['time'].astype(str).str[:10].map(time_index).to_numpy(np.int16) for f in forecasts]))
+    _save(tmp, 'forecast_offsets', _offsets(forecasts))
+    _save(tmp, 'climatology_values', _stack(climatologies, columns))
+    _save(tmp, 'climatology_month', np.concatenate([
+        c['month'].to_numpy(np.int8) for c in climatologies]))
+    _save(tmp, 'climatology_offsets', _offsets(climatologies))
+
+    from modules.quantiles import compute_quantiles
+
+    stats = [compute_quantiles(f, columns) for f in forecasts]
+    _save(tmp, 'quantile_values', np.concatenate([values for _, _, values in stats]))
+    _save(tmp, 'quantile_time', np.concatenate([
+        np.array([time_index[t] for t in times], dtype=np.int16) for times, _, _ in stats]))
+    _save(tmp, 'quantile_offsets', _offsets([times for times, _, _ in stats]))
+    (tmp / 'geometry.json').write_text(
+        json.dumps(simplify_geojson(geojson_data), separators=(',', ':')))
+    (tmp / 'manifest.json').write_text(json.dumps({
+        'release_id': release_id,
+        'columns': columns,
+        'n_basins': len(ids),
+        'published_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }, indent=2))
+
+    target = root / release_id
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(tmp, target)
+    pointer = root / f'.CURRENT.tmp-{os.getpid()}'
+    pointer.write_text(release_id)
+    os.replace(pointer, root / 'CURRENT')
+
+    # Workers re-attach within REFRESH_INTERVAL_S; older releases can then go
+    releases = sorted((p for p in root.iterdir() if p.is_dir() and not p.name.startswith('.')),
+                      key=lambda p: p.stat().st_mtime, reverse=True)
+    for old in releases[keep:]:
+        shutil.rmtree(old, ignore_errors=True)
+    return target
+
+
+def simplify_geojson(geojson_data, precision=GEOMETRY_PRECISION):
+    """
+    Rounds coordinates and drops the repeated vertices this creates.
+
+    Parameters:
+        geojson_data (dict): GeoJSON FeatureCollection
+        precision (int): Decimal places to keep
+
+    Returns:
+        dict: Simplified FeatureCollection (only PFAF_ID and SUB_AREA properties)
+    """
+    def ring(coords):
+        out = []
+        for x, y in coords:
+            point = [round(x, precision), round(y, precision)]
+            if not out or out[-1] != point:
+                out.append(point)
+        return out
+
+    features = []
+    for feature in geojson_data['features']:
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            coordinates = [ring(r) for r in geometry['coordinates']]
+        else:
+            coordinates = [[ring(r) for r in polygon] for polygon in geometry['coordinates']]
+        properties = feature['properties']
+        features.append({
+            'type': 'Feature',
+            'properties': {k: properties[k] for k in ('PFAF_ID', 'SUB_AREA') if k in properties},
+            'geometry': {'type': geometry['type'], 'coordinates': coordinates},
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def _save(directory, name, array):
+    np.save(directory / f'{name}.npy', array, allow_pickle=False)
+
+
+def _stack(frames, columns):
+    return np.concatenate(
+        [f.reindex(columns=columns).to_numpy(np.float32) for f in frames])
+
+
+def _offsets(frames):
+    return np.concatenate([[0], np.cumsum([len(f) for f in frames])]).astype(np.int64)
+
+
+def main():
+    import shared
+    from modules import datasource, mapping, zonal
+
+    parser = argparse.ArgumentParser(description='Publish a release into the shared data plane.')
+    parser.add_argument('command', choices=['publish'])
+    parser.add_argument('--release', required=True, help='Release id, e.g. 2025-01')
+    parser.add_argument('--root', default=ROOT, help='Data plane directory')
+    args = parser.parse_args()
+    if args.root is None:
+        parser.error('--root is required where /dev/shm does not exist')
+
+    # Read the backend itself: neither the live release nor another
+    # process's cached copies may end up in the new one
+    cache_dir = tempfile.mkdtemp(prefix='hydroviewer-publish-')
+    datasource.CACHE_DIR = cache_dir
+    try:
+        geojson_data = mapping.load_geojson()
+        missing = zonal.build_rollups(geojson_data, use_plane=False)
+        if missing:
+            parser.exit(1, f'{len(missing)} of {len(geojson_data["features"])} basins could '
+                           f'not be loaded (e.g. {", ".join(missing[:5])}); '
+                           f'release {args.release} was not published\n')
+        # Levels 1-4 from the roll-ups, level 5 from the download cache just filled
+        tables = {pfaf_id: t for pfaf_id, t in zonal.iter_cached_tables()
+                  if zonal.pfaf_level(pfaf_id) < shared.PFAF_BASE_LEVEL}
+        for feature in geojson_data['features']:
+            pfaf_id = str(feature['properties']['PFAF_ID'])
+            tables[pfaf_id] = zonal.get_zonal_tables(pfaf_id, cache=False, use_plane=False)
+        target = publish(args.root, args.release, tables, geojson_data)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    print(f'Published {len(tables)} basins to {target}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+"""
+Stale-while-revalidate access to the upstream data sources.
+
+Everything fetched from an upstream (the GitHub-hosted backend, the tile
+server) goes through a `Source`, which keeps the last good copy of every
+response in memory and on disk, in a directory private to the user. A cached
+copy is returned immediately, even when it is older than the source's max
+age; a background refresh then replaces it. Callers only wait for the
+network when nothing has ever been fetched for a key.
+
+Each source has its own timeout and circuit breaker: after a few consecutive
+failures the source is skipped for a while, so a down upstream costs cached
+readers nothing and uncached readers fail fast instead of waiting for
+timeouts. Only failures of the upstream itself (connection errors, timeouts,
+5xx responses) count; a 404 for one key says nothing about the others.
+"""
+
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+from modules import metrics
+from modules.singleflight import SingleFlight
+
+
+# Cached copies are pickles, so only a directory nobody else can write to is used
+CACHE_DIR = os.environ.get('HYDROVIEWER_CACHE_DIR') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'hydroviewer')
+
+# Directory -> whether it passed `_is_private_dir`
+_private_dirs = {}
+
+# Background refreshes of stale entries
+_refresh_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='datasource-refresh')
+
+
+class SourceUnavailable(Exception):
+    """
+    Raised when a source cannot be reached and nothing is cached for the key.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling a source after repeated failures.
+
+    Closed: calls go through. Open: calls are refused until `reset_after_s`
+    has passed, then one trial call is let through (half open); its success
+    closes the breaker again.
+
+    Parameters:
+        name (str): Source name, used in the metrics
+        failure_threshold (int): Consecutive failures that open the breaker
+        reset_after_s (float): Seconds before a trial call is allowed
+    """
+
+    def __init__(self, name, failure_threshold=3, reset_after_s=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_after_s = reset_after_s
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        """
+        Returns True if a call may go to the source now.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_after_s:
+                return False
+            # Half open: let this call through and hold the others back
+            self._opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+        metrics.set_gauge('hydroviewer_circuit_open', 0, source=self.name)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+        if self.is_open:
+            metrics.set_gauge('hydroviewer_circuit_open', 1, source=self.name)
+
+
+class Source:
+    """
+    One upstream with its timeout, breaker and last-known-good cache.
+
+    Parameters:
+        name (str): Source name, also the cache subdirectory
+        timeout (float): Seconds passed to loaders as their request timeout
+        max_age_s (float): Age after which a cached copy is refreshed
+        failure_threshold (int): See `CircuitBreaker`
+        reset_after_s (float): See `CircuitBreaker`
+    """
+
+    def __init__(self, name, timeout, max_age_s, failure_threshold=3, reset_after_s=30.0):
+        self.name = name
+        self.timeout = timeout
+        self.max_age_s = max_age_s
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_after_s)
+        self._memory = {}  # key -> (fetched_at, value)
+        self._flight = SingleFlight(f'datasource_{name}')
+
+    def get(self, key, loader, memory=True, on_refresh=None):
+        """
+        Returns the value of `key`, from cache if possible.
+
+        Parameters:
+            key (hashable): Identity of the value (its repr names the disk file)
+            loader (callable): Called with the timeout, returns the fresh value
+            memory (bool): Also keep the value in memory (callers with their
+                own cache pass False)
+            on_refresh (callable): Called with the new value after a
+                background refresh
+
+        Returns:
+            The cached or freshly loaded value
+
+        Raises:
+            SourceUnavailable: If loading fails and nothing is cached
+        """
+        entry = self._memory.get(key) or self._read_disk(key)
+        if entry is not None:
+            if memory:
+                self._memory[key] = entry
+            fetched_at, value = entry
+            fresh = time.time() - fetched_at <= self.max_age_s
+            metrics.inc('hydroviewer_cache_requests_total', cache=f'datasource_{self.name}',
+                        result='hit' if fresh else 'stale')
+            if not fresh:
+                self._refresh(key, loader, memory, on_refresh)
+            return value
+
+        metrics.inc('hydroviewer_cache_requests_total', cache=f'datasource_{self.name}',
+                    result='miss')
+        return self._flight.do(key, lambda: self._load(key, loader, memory))
+
+    def fetched_at(self, key):
+        """
+        Returns when the cached copy of `key` was fetched (epoch seconds), or None.
+
+        Cheap: reads the memory entry or the cache file's modification time.
+        """
+        entry = self._memory.get(key)
+        if entry is not None:
+            return entry[0]
+        path = self._path(key)
+        try:
+            return os.path.getmtime(path) if path is not None else None
+        except OSError:
+            return None
+
+    def clear(self):
+        """
+        Drops every cached value of this source, in memory and on disk.
+        """
+        import shutil
+
+        self._memory.clear()
+        shutil.rmtree(os.path.join(CACHE_DIR, self.name), ignore_errors=True)
+
+    def _load(self, key, loader, memory):
+        if not self.breaker.allow():
+            raise SourceUnavailable(f"{self.name} is unavailable (circuit open)")
+        try:
+            value = loader(self.timeout)
+        except Exception as e:
+            if is_upstream_failure(e):
+                self.breaker.record_failure()
+            else:
+                # The upstream answered; only this key is bad
+                self.breaker.record_success()
+            metrics.inc('hydroviewer_errors_total', source=f'datasource_{self.name}')
+            raise SourceUnavailable(f"{self.name} request failed: {e}") from e
+        self.breaker.record_success()
+
+        entry = (time.time(), value)
+        if memory:
+            self._memory[key] = entry
+        self._write_disk(key, entry)
+        return value
+
+    def _refresh(self, key, loader, memory, on_refresh):
+        if self._flight.inflight(key):
+            return
+        future, leader = self._flight.submit(
+            key, lambda: self._load(key, loader, memory), _refresh_pool)
+        if leader and on_refresh is not None:
+            future.add_done_callback(
+                lambda f: f.exception() is None and on_refresh(f.result()))
+
+    def _path(self, key):
+        """
+        Returns the cache file of `key`, or None if the cache directory is not private.
+        """
+        if not _is_private_dir(CACHE_DIR):
+            return None
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(CACHE_DIR, self.name, f'{digest}.pkl')
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def _write_disk(self, key, entry):
+        path = self._path(key)
+        if path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError:
+            # A read-only or full disk only costs the persistence
+            metrics.inc('hydroviewer_errors_total', source='datasource_disk')
+
+
+def _is_private_dir(path):
+    """
+    Creates `path` (mode 0700) if needed and checks that only this user can write to it.
+
+    A directory owned by someone else, writable by others or behind a symlink
+    is refused with a warning, and the cache then stays in memory only.
+    """
+    private = _private_dirs.get(path)
+    if private is not None:
+        return private
+    private = False
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.lstat(path)
+        if stat.S_ISDIR(info.st_mode) and (not hasattr(os, 'getuid')
+                                           or info.st_uid == os.getuid()):
+            if info.st_mode & 0o077:
+                os.chmod(path, 0o700)
+            private = True
+    except OSError:
+        pass
+    if not private:
+        warnings.warn(f"Not using {path} as cache directory: it is not a private "
+                      f"directory of this user", RuntimeWarning)
+        metrics.inc('hydroviewer_errors_total', source='datasource_disk')
+    _private_dirs[path] = private
+    return private
+
+
+def is_upstream_failure(error):
+    """
+    Returns True if an error means the upstream is down or overloaded.
+
+    Connection errors, timeouts and 5xx responses count; 4xx responses and
+    errors parsing a response do not.
+
+    Parameters:
+        error (Exception): Error raised by a loader
+
+    Returns:
+        bool
+    """
+    import requests
+
+    if isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                              ConnectionError, TimeoutError))
+
+
+# GitHub-hosted backend: basin polygons and zonal CSVs, updated once per release
+BACKEND = Source('backend', timeout=30, max_age_s=6 * 3600)
+
+# Tile server metadata (available time steps)
+TILE_SERVER = Source('tile_server', timeout=10, max_age_s=300)
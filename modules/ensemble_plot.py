@@ -0,0 +1,205 @@
+"""
+Ensemble box plot of the zonal statistics of a basin.
+"""
+
+import plotly.graph_objects as go
+
+import shared
+from modules import interface, metrics, plotly_theme, quantiles, zonal
+
+
+def build_empty_boxplot(message, **layout):
+    """
+    Returns an empty figure showing `message` with Brutalist styling.
+
+    Parameters:
+        message (str): Message to display
+        **layout: Additional layout parameters
+
+    Returns:
+        go.Figure: The figure
+    """
+    ensemblebox = go.Figure()
+    ensemblebox.update_layout(
+        **plotly_theme.get_brutalist_layout(
+            annotations=[plotly_theme.get_empty_state_annotation(message)],
+            **layout,
+        )
+    )
+    return ensemblebox
+
+
+def build_boxplot(pfaf_id, var, depth, members=False):
+    """
+    Builds the ensemble spread of a basin against its climatology.
+
+    By default the boxes are drawn from precomputed quantiles, so only a few
+    numbers per time step are sent to the browser; their whiskers span the
+    5th to 95th percentiles. With `members` every ensemble member is sent and
+    drawn next to its box, with Plotly's 1.5 IQR whiskers.
+
+    Parameters:
+        pfaf_id (str): Pfafstetter code of the basin
+        var (str): Variable name
+        depth (str or int): Soil profile index (see mapping.get_profile)
+        members (bool): Draw the individual ensemble members
+
+    Returns:
+        go.Figure: The figure
+    """
+    var_col = (f"{var}_lvl_{depth}" if var in shared.SOIL_VARIABLES else var)
+    try:
+        if members:
+            ensemblebox, time_labels, climatology_tab = _build_member_boxes(pfaf_id, var_col)
+        else:
+            ensemblebox, time_labels, climatology_tab = _build_quantile_boxes(pfaf_id, var_col)
+    except Exception as e:
+        metrics.inc('hydroviewer_errors_total', source='boxplot')
+        return build_empty_boxplot(f"ERROR LOADING DATA<br>{str(e)}", height=420)
+
+    # Climatology of the month of each time step
+    climatology_by_month = climatology_tab[var_col].groupby(level=0).first()
+    climatology = [float(climatology_by_month[int(month[-2:])]) for month in time_labels]
+
+    ensemblebox.add_trace(
+        go.Scatter(
+            y=climatology,
+            x=time_labels,
+            mode="lines+markers",
+            name=f"(Climatology Mean)",
+            line=dict(color="black", dash="dot"),
+            marker=dict(color="black", size=6),
+            hovertemplate='<b>Climatology</b><br>%{x}<br>Mean: %{y}<extra></extra>',
+        )
+    )
+
+    # Apply Brutalist theme with custom title and axis labels
+    var_name = shared.CLIM_VAR_META.get(var)['long_name'].upper()
+    var_unit = shared.CLIM_VAR_META.get(var)['unit']
+    depth_label = shared.SOIL_VAR_PROFILE.get(int(depth))
+
+    ensemblebox.update_layout(
+        **plotly_theme.get_brutalist_layout(
+            title={
+                'text': f"ENSEMBLE SPREAD: {var_name} | REGION {pfaf_id} | DEPTH {depth_label}",
+            },
+            xaxis={
+                'title': {'text': 'TIME PERIOD'},
+                'showgrid': False,
+            },
+            yaxis={
+                'title': {'text': f"{var_name} ({var_unit})"},
+            },
+        )
+    )
+
+    return ensemblebox
+
+
+def _build_quantile_boxes(pfaf_id, var_col):
+    """
+    Returns the box traces drawn from precomputed quantiles.
+
+    Whiskers span the 5th to 95th percentiles: Plotly's 1.5 IQR rule needs
+    the members to place them and draw the outliers, which are not sent.
+    """
+    stats = quantiles.get_quantiles(pfaf_id)
+    q1, median, q3 = (stats.stat(var_col, name) for name in ('p25', 'p50', 'p75'))
+    lowerfence, upperfence = stats.stat(var_col, 'p5'), stats.stat(var_col, 'p95')
+    mean = stats.stat(var_col, 'mean')
+
+    ensemblebox = go.Figure()
+    time_labels = []
+    for i, t in enumerate(stats.times):
+        month = interface.format_date(t)
+        time_labels.append(month)
+        ensemblebox.add_trace(
+            go.Box(
+                x=[month],
+                q1=[float(q1[i])], median=[float(median[i])], q3=[float(q3[i])],
+                lowerfence=[float(lowerfence[i])], upperfence=[float(upperfence[i])],
+                mean=[float(mean[i])],
+                name=month,
+                marker_color=None,  # Let Plotly pick auto color
+                hoverinfo='x + y',
+            )
+        )
+    return ensemblebox, time_labels, stats.climatology
+
+
+def _build_member_boxes(pfaf_id, var_col):
+    """
+    Returns the box traces computed by Plotly from every ensemble member.
+    """
+    # One-off member view: keep the full member table out of the process cache
+    zonal_stats_tab, zonal_climatology_tab = zonal.get_zonal_tables(
+        pfaf_id, timeout=60, cache=False)
+
+    ensemblebox = go.Figure()
+    time_labels = []
+    for t in sorted(zonal_stats_tab["time"].unique()):
+        month = interface.format_date(t)
+        data_for_t = zonal_stats_tab.loc[zonal_stats_tab["time"]== t, var_col]
+        time_labels.append(month)
+
+        # Add forecast data to box plot for this time step
+        ensemblebox.add_trace(
+            go.Box(
+                y=data_for_t,
+                x= [month] * len(data_for_t),
+                name=month,
+                marker_color=None,  # Let Plotly pick auto color
+                boxpoints='all',
+                jitter=0.4,
+                hoverinfo='x + y',  # Show only y-axis values in hover
+            )
+        )
+    return ensemblebox, time_labels, zonal_climatology_tab.set_index("month")
+
+
+def update_figure(widget, figure):
+    """
+    Makes a displayed FigureWidget show `figure`, sending only what changed.
+
+    Plotly widgets only send properties whose value changes, so a figure with
+    the same traces (same basin and time steps) is patched in place instead of
+    re-sent whole. Otherwise the traces are replaced.
+
+    Parameters:
+        widget (go.FigureWidget): Widget shown in the browser
+        figure (go.Figure): Figure to show
+    """
+    same_traces = [t.type for t in widget.data] == [t.type for t in figure.data]
+    layout = figure.layout.to_plotly_json()
+    with widget.batch_update():
+        if same_traces:
+            for trace, new in zip(widget.data, figure.data):
+                props = new.to_plotly_json()
+                props.pop('type', None)
+                props.pop('uid', None)
+                trace.update(props)
+        # Replace the layout outright: unset every (nested) property the new
+        # figure does not have, e.g. the axis titles of an error figure
+        new_paths = _layout_paths(layout)
+        for path in _layout_paths(widget.layout.to_plotly_json()):
+            if path not in new_paths and not any(p.startswith(path + '.') for p in new_paths):
+                widget.layout[path] = None
+        widget.update(layout=layout, overwrite=True)
+    if not same_traces:
+        widget.data = ()
+        widget.add_traces(list(figure.data))
+
+
+def _layout_paths(props, prefix=''):
+    """
+    Returns the dotted paths of the leaf properties of a layout dict, except its template.
+    """
+    paths = set()
+    for key, value in props.items():
+        if not prefix and key == 'template':
+            continue
+        if isinstance(value, dict) and value:
+            paths |= _layout_paths(value, f'{prefix}{key}.')
+        else:
+            paths.add(f'{prefix}{key}')
+    return paths
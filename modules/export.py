@@ -0,0 +1,267 @@
+"""
+Bulk export of basin forecasts as streamed CSV, Parquet or NetCDF.
+
+Basins are read and written one at a time by a chain of generators, so memory
+stays constant however many basins are exported, and the output starts
+flowing as soon as the first basin is ready.
+"""
+
+import datetime
+import os
+import tempfile
+
+import shared
+from modules import metrics, zonal
+
+
+# format -> (media type, file extension)
+FORMATS = {
+    'csv': ('text/csv', '.csv'),
+    'parquet': ('application/vnd.apache.parquet', '.parquet'),
+    'netcdf': ('application/x-netcdf', '.nc'),
+}
+
+CHUNK_SIZE = 1 << 16
+
+
+def export_columns(variables, levels):
+    """
+    Returns the zonal table columns of the selected variables and soil levels.
+
+    Parameters:
+        variables (list): Variable names
+        levels (list): Soil profile indices (used for soil variables only)
+
+    Returns:
+        list: Column names
+
+    Raises:
+        ValueError: If a variable or soil level does not exist
+    """
+    unknown = [var for var in variables if var not in shared.CLIM_VAR_META]
+    if unknown:
+        raise ValueError(f"Unknown variables {unknown}")
+    profiles = []
+    for level in levels:
+        try:
+            profiles.append(int(level))
+        except (TypeError, ValueError):
+            profiles.append(None)
+        if profiles[-1] not in shared.SOIL_VAR_PROFILE:
+            raise ValueError(f"Unknown soil level {level!r}, expected one of "
+                             f"{sorted(shared.SOIL_VAR_PROFILE)}")
+    columns = []
+    for var in variables:
+        if var in shared.SOIL_VARIABLES:
+            columns += [f"{var}_lvl_{profile}" for profile in profiles]
+        else:
+            columns.append(var)
+    return columns
+
+
+def iter_basin_frames(pfaf_ids, variables, levels, times=None):
+    """
+    Yields one long-format DataFrame chunk per basin.
+
+    Parameters:
+        pfaf_ids (iterable): Pfafstetter codes
+        variables (list): Variable names
+        levels (list): Soil profile indices
+        times (list): 'YYYY-MM-DD' time steps to keep (None keeps all)
+
+    Yields:
+        DataFrame: Columns PFAF_ID, time, member and the selected variables
+
+    Raises:
+        RuntimeError: If a basin cannot be loaded; an export missing basins
+            would look complete, so the stream is aborted instead
+    """
+    columns = export_columns(variables, levels)
+    times = set(times) if times else None
+    for pfaf_id in pfaf_ids:
+        try:
+            forecast, _ = zonal.get_zonal_tables(pfaf_id, timeout=60, cache=False)
+        except Exception as e:
+            metrics.inc('hydroviewer_errors_total', source='export')
+            raise RuntimeError(f"Export aborted: basin {pfaf_id} could not be loaded ({e})") from e
+        frame = forecast[['time'] + [c for c in columns if c in forecast.columns]]
+        frame = frame.assign(time=frame['time'].astype(str).str[:10])
+        if times is not None:
+            frame = frame[frame['time'].isin(times)]
+        frame = frame.assign(
+            member=frame.groupby('time').cumcount(),
+            PFAF_ID=str(pfaf_id),
+        )
+        # Columns missing in a basin stay in the schema as NaN
+        yield frame.reindex(columns=['PFAF_ID', 'time', 'member'] + columns)
+
+
+def stream_export(fmt, pfaf_ids, variables, levels, times=None):
+    """
+    Returns a generator of the bytes of an export file, chunk by chunk.
+
+    The arguments are checked here, before anything is generated, so a bad
+    request can still be answered with an error status.
+
+    Parameters:
+        fmt (str): One of FORMATS
+        pfaf_ids, variables, levels, times: See `iter_basin_frames`
+
+    Returns:
+        generator: Yields the file content as bytes
+
+    Raises:
+        ValueError: If the format, a variable, a soil level or a time step is invalid
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}, expected one of {sorted(FORMATS)}")
+    export_columns(variables, levels)
+    for t in times or []:
+        try:
+            datetime.date.fromisoformat(t)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid time step {t!r}, expected YYYY-MM-DD") from None
+    return _stream(fmt, iter_basin_frames(pfaf_ids, variables, levels, times))
+
+
+def _stream(fmt, frames):
+    writer = {'csv': _stream_csv, 'parquet': _stream_parquet, 'netcdf': _stream_netcdf}[fmt]
+    with metrics.timer('hydroviewer_export_seconds', format=fmt):
+        yield from writer(frames)
+
+
+def _stream_csv(frames):
+    header = True
+    for frame in frames:
+        yield frame.to_csv(index=False, header=header).encode()
+        header = False
+
+
+class _ChunkSink:
+    """
+    Write-only file object handing written bytes back to a generator.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def _stream_parquet(frames):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = _ChunkSink()
+    writer = None
+    try:
+        for frame in frames:
+            if writer is None:
+                table = pa.Table.from_pandas(frame, preserve_index=False)
+                writer = pq.ParquetWriter(sink, table.schema)
+            else:
+                table = pa.Table.from_pandas(frame, schema=writer.schema, preserve_index=False)
+            # One row group per basin
+            writer.write_table(table)
+            yield sink.drain()
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.drain()
+
+
+def _stream_netcdf(frames):
+    """
+    NetCDF cannot be written to a pipe, so rows are appended basin by basin
+    along an unlimited dimension of a temporary file, which is then streamed.
+    """
+    import netCDF4
+
+    fd, path = tempfile.mkstemp(suffix='.nc')
+    os.close(fd)
+    try:
+        with netCDF4.Dataset(path, 'w') as ds:
+            ds.createDimension('row', None)
+            ds.title = 'Amazon HydroViewer zonal forecast export'
+            columns = None
+            n = 0
+            for frame in frames:
+                if columns is None:
+                    columns = list(frame.columns)
+                    for name in columns:
+                        if name in ('PFAF_ID', 'time'):
+                            ds.createVariable(name, str, ('row',))
+                        elif name == 'member':
+                            ds.createVariable(name, 'i4', ('row',))
+                        else:
+                            var = ds.createVariable(name, 'f4', ('row',), fill_value=float('nan'))
+                            meta = shared.CLIM_VAR_META.get(name.split('_lvl_')[0], {})
+                            if meta:
+                                var.long_name = meta['long_name']
+                                var.units = meta['unit']
+                rows = slice(n, n + len(frame))
+                for name in columns:
+                    values = frame[name].to_numpy()
+                    ds[name][rows] = values.astype(object) if name in ('PFAF_ID', 'time') else values
+                n += len(frame)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+def parse_list(value):
+    """
+    Splits a comma-separated query parameter.
+    """
+    return [v.strip() for v in (value or '').split(',') if v.strip()]
+
+
+async def export_endpoint(request, geojson_data):
+    """
+    Starlette endpoint: /export?pfaf=62001,62002&var=Rainf_tavg&level=0&time=2025-01-01&format=csv
+
+    `pfaf=all` (or no pfaf) exports every level 5 basin; no `var` exports
+    every variable and no `time` every time step. If a basin cannot be loaded
+    once the response has started, the connection is closed before the end
+    of the body, so clients see a failed download rather than a short file.
+    """
+    from starlette.responses import PlainTextResponse, StreamingResponse
+
+    params = request.query_params
+    fmt = params.get('format', 'csv')
+    pfaf_ids = parse_list(params.get('pfaf'))
+    if not pfaf_ids or pfaf_ids == ['all']:
+        pfaf_ids = [str(f['properties']['PFAF_ID']) for f in geojson_data['features']]
+    variables = parse_list(params.get('var')) or list(shared.CLIM_VAR_META)
+    levels = parse_list(params.get('level')) or list(shared.SOIL_VAR_PROFILE)
+    # Errors past this point would come after the 200 status line
+    try:
+        chunks = stream_export(fmt, pfaf_ids, variables, levels, parse_list(params.get('time')))
+    except ValueError as e:
+        return PlainTextResponse(str(e), status_code=400)
+
+    media_type, extension = FORMATS[fmt]
+    # Starlette iterates sync generators in a worker thread, off the event loop
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={'Content-Disposition': f'attachment; filename="hydroviewer_export{extension}"'},
+    )
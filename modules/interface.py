@@ -26,13 +26,37 @@ def build_sidebar_content():
             ),
         ),
 
+        # Layer shown on the map
+        ui.input_select(
+            "layer_selector",
+            "Map layer:",
+            choices=MAP_LAYERS,
+            selected='probability'),
+
         # Buttons to select data type
-        ui.input_selectize(
-            "forecast_category_selector", 
-            "Select Category:", 
-            choices=FORECAST_PCATE, # 'Deterministic' 
-            selected=0),
+        ui.panel_conditional(
+            "input.layer_selector == 'probability'",
+            ui.input_selectize(
+                "forecast_category_selector", 
+                "Select Category:", 
+                choices=FORECAST_PCATE, # 'Deterministic' 
+                selected=0),
+        ),
         
+        # Bulk download of the zonal forecasts
+        ui.input_select(
+            "export_format",
+            "Download forecasts as:",
+            choices={'csv': 'CSV', 'parquet': 'Parquet', 'netcdf': 'NetCDF'},
+            selected='csv'),
+        ui.input_radio_buttons(
+            "export_scope",
+            None,
+            choices={'basin': 'Selected basin', 'all': 'All basins'},
+            selected='basin'),
+        # Replaced by a notice while no basin is selected (see build_export_button)
+        ui.output_ui("export_button"),
+
         # Url portal to documentation 
         ui.a('To docs pages \N{Page with Curl}', 
              href = "https://blackteacatsu.github.io/dokkuments", 
@@ -57,6 +81,20 @@ def build_sidebar_content():
 """
 Define callback function that captures user's cursor click on map
 """
+"""
+Download button of the export, or a notice when there is nothing to export
+"""
+def build_export_button(basin_missing=False):
+    if basin_missing:
+        # Exporting every basin instead would surprise whoever picked one basin
+        return ui.p("Click a basin on the map to download its forecasts, "
+                    "or choose All basins.")
+    return ui.download_button(
+        "export_download",
+        'Download forecasts \N{Inbox Tray}',
+        class_="btn btn-primary")
+
+
 def on_polygon_click(trace):
     # Reactive value to store selected PFAF_ID
     clicked_pfaf_id = reactive.Value('Waiting input')
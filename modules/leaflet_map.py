@@ -0,0 +1,349 @@
+"""
+Leaflet map creation and rendering.
+"""
+
+from ipyleaflet import Map, basemaps, TileLayer, GeoJSON, WidgetControl, LayersControl, basemap_to_tiles
+from ipywidgets import HTML
+
+import shared
+from modules import anomaly, caching, interface, mapping, zonal
+
+
+# CSS styling to match app font
+HOVER_STYLE = """
+    font-family: 'Space Grotesk', sans-serif;
+    font-size: 14px;
+    padding: 8px 12px;
+    background: white;
+    border-radius: 4px;
+    box-shadow: 0 1px 4px rgba(0,0,0,0.2);
+"""
+
+# Served by the app from static/, versioned so browsers keep them cached
+LEGEND_URLS = {
+    'temp': caching.versioned('static/probability_legend_temp.png'),
+    'default': caching.versioned('static/probability_legend_default.png'),
+}
+
+
+FORECAST_OPACITY = 0.8
+
+
+def build_heatmap(variable, category, profile, time_id, geojson_data, on_select=None):
+    """
+    Builds the map of tercile probabilities with the clickable basins on top.
+
+    Parameters:
+        variable (str): Variable name
+        category (int): Tercile category index
+        profile (int): Soil profile index
+        time_id (str or date): Forecast time step
+        geojson_data (dict): Level 5 basins GeoJSON
+        on_select (callable): Called with the PFAF_ID (str) of a clicked basin
+
+    Returns:
+        ipyleaflet.Map: The map widget
+    """
+    m = build_base_map(variable, geojson_data, on_select)
+    m.add_layer(build_forecast_layer(
+        mapping.build_tile_url(variable, time_id, category, profile),
+        f"{variable} - Category {category}",
+    ))
+    return m
+
+
+def build_forecast_layer(tile_url, name, opacity=FORECAST_OPACITY):
+    """
+    Returns the TileLayer of one forecast time step.
+
+    Parameters:
+        tile_url (str): URL template from `mapping.build_tile_url`
+        name (str): Name shown in the layers control
+        opacity (float): Initial opacity
+
+    Returns:
+        ipyleaflet.TileLayer: The layer
+    """
+    return TileLayer(
+            url=tile_url,
+            name=name,
+            opacity=opacity,
+            attribution='HydroViewer',
+            min_native_zoom=4,
+            max_native_zoom=9,
+            tms=True,
+    )
+
+
+def build_base_map(variable, geojson_data, on_select=None, legend=None):
+    """
+    Builds the map with basemap, clickable basins, hover box and legend, but no forecast layer.
+
+    Parameters:
+        variable (str): Variable name (selects the legend)
+        geojson_data (dict): Level 5 basins GeoJSON
+        on_select (callable): Called with the PFAF_ID (str) of a clicked basin
+        legend (str): HTML replacing the tercile probability legend image
+
+    Returns:
+        ipyleaflet.Map: The map widget
+    """
+    polygon_layer = GeoJSON(
+        data=geojson_data,
+        style={
+            'color': 'grey',
+            'weight': 0.6,
+            'fillOpacity': 0,
+            'opacity': 1
+        },
+        hover_style={
+            'color': 'grey',
+            'weight': 0,
+            'fillOpacity': 0.4
+        },
+        name=f'HydroBasins @lvl {shared.PFAF_BASE_LEVEL}'
+    )
+
+    m = Map(
+        center=[-7, -66],
+        zoom=4,
+        scroll_wheel_zoom=True,
+        max_zoom = 9,
+        basemap = basemap_to_tiles(basemaps.Stadia.AlidadeSmoothDark,
+                                   "CartoDB Positron") #Stadia.AlidadeSmooth
+    )
+
+    layercontrol = LayersControl(position='bottomright')
+    m.add_control(layercontrol)
+
+    m.add_layer(polygon_layer)
+
+    hover_info = HTML(value=f'<div style="{HOVER_STYLE}"><b>Hover over a basin</b></div>')
+    hover_control = WidgetControl(widget=hover_info, position='topright')
+    m.add_control(hover_control)
+
+    # Add colorsale to map
+    colorbar_html_content = '''
+    <div style="background-color: white;
+        border-radius: 4px;
+        padding: 8px 12px;
+        box-shadow: 0 2px 6px rgba(0,0,0,0.2);
+        max-width: 500px; height: auto;">'''
+    colorbar_html_content += f'''
+    <div style="margin-bottom: 15px;">
+        <div style="font-size: 11px;
+                    font-weight: bold;
+                    color: #333;
+                    margin-bottom: 5px;
+                    text-align: center;">
+        </div>
+        <img src="{LEGEND_URLS['temp'] if variable in shared.TEMPERATURE_VARIABLES else LEGEND_URLS['default']}"
+                   style="width: 100%; height: auto;">
+    </div>
+    ''' if legend is None else legend
+    legend_info = HTML(value=colorbar_html_content)
+    colorbar_control = WidgetControl(widget=legend_info, position='bottomleft')
+    m.add_control(colorbar_control)
+
+    def on_hover(event, feature, **kwargs):
+        pfaf_id = feature['properties'].get('PFAF_ID', 'N/A')
+        hover_info.value = f'<div style="{HOVER_STYLE}"><b>Regional PFAF ID:</b> {pfaf_id}</div>'
+
+    polygon_layer.on_hover(on_hover)
+
+    def on_polygon_click(event, feature, **kwargs):
+        if feature and "properties" in feature:
+            pfaf_id = feature["properties"].get("PFAF_ID")
+            if pfaf_id is not None and on_select is not None:
+                on_select(str(pfaf_id))
+
+    polygon_layer.on_click(on_polygon_click)
+
+    # Hover and click on coarser basins when zoomed out
+    def on_zoom(change):
+        level = zonal.level_for_zoom(change['new'])
+        basins = zonal.get_basin_geojson(geojson_data, level)
+        if basins is not None and basins is not polygon_layer.data:
+            polygon_layer.data = basins
+            polygon_layer.name = f'HydroBasins @lvl {level}'
+
+    m.observe(on_zoom, names='zoom')
+
+    return m
+
+
+class FramePlayer:
+    """
+    Map with one forecast TileLayer per lead time, for animated playback.
+
+    The current frame and the next `prefetch` frames are kept on the map; the
+    upcoming ones sit at zero opacity so the browser loads their viewport
+    tiles ahead of time. Switching frames only changes layer opacities (faded
+    by the `.leaflet-layer` transition in styles.css) instead of rebuilding
+    the map.
+
+    Parameters:
+        variable (str): Variable name
+        category (int): Tercile category index
+        profile (int): Soil profile index
+        time_steps (list): Forecast time steps, in playback order
+        geojson_data (dict): Level 5 basins GeoJSON
+        on_select (callable): Called with the PFAF_ID (str) of a clicked basin
+        prefetch (int): Number of upcoming frames to preload
+    """
+
+    def __init__(self, variable, category, profile, time_steps, geojson_data,
+                 on_select=None, prefetch=shared.PLAYBACK_PREFETCH):
+        self.name = f"{variable} - Category {category}"
+        self.time_steps = list(time_steps)
+        self.urls = [mapping.build_tile_url(variable, t, category, profile)
+                     for t in self.time_steps]
+        self.prefetch = prefetch
+        self.layers = {}  # frame index -> TileLayer
+        self.index = None
+        self.map = build_base_map(variable, geojson_data, on_select)
+        self.show(0)
+
+    def show(self, index):
+        """
+        Makes frame `index` visible and preloads the frames after it.
+
+        Parameters:
+            index (int): Frame (lead time) index
+        """
+        n = len(self.urls)
+        index = max(0, min(int(index), n - 1))
+        # Playback loops, so the frames after the last one are the first ones
+        wanted = {(index + k) % n for k in range(min(self.prefetch, n - 1) + 1)}
+
+        for i in sorted(wanted - self.layers.keys()):
+            self.layers[i] = build_forecast_layer(
+                self.urls[i], f"{self.name} - {self.time_steps[i]}", opacity=0)
+            self.map.add_layer(self.layers[i])
+
+        for i, layer in self.layers.items():
+            layer.opacity = FORECAST_OPACITY if i == index else 0
+
+        # Keep the outgoing frame so it can fade out; drop everything else
+        for i in list(self.layers):
+            if i not in wanted and i != self.index:
+                self.map.remove_layer(self.layers.pop(i))
+
+        self.index = index
+
+
+class LayerPlayer:
+    """
+    Map of a derived layer (see modules/anomaly.py) coloring the level 5 basins.
+
+    Same interface as `FramePlayer`: every lead time gets its own styled
+    GeoJSON layer, built when it is first shown or preloaded, and switching
+    lead times only swaps which one is on the map. Restyling a single layer
+    would send all basin geometry to the browser on every frame; this way
+    each frame is sent once. Never waits for the layers: while they are
+    computed a notice is shown instead.
+
+    Parameters:
+        layer (str): One of shared.DERIVED_LAYERS
+        variable (str): Variable name
+        profile (int): Soil profile index
+        time_steps (list): Forecast time steps, in playback order
+        geojson_data (dict): Level 5 basins GeoJSON
+        on_select (callable): Called with the PFAF_ID (str) of a clicked basin
+        prefetch (int): Number of upcoming frames to preload
+    """
+
+    def __init__(self, layer, variable, profile, time_steps, geojson_data, on_select=None,
+                 prefetch=shared.PLAYBACK_PREFETCH):
+        self.name = shared.DERIVED_LAYERS[layer]['long_name']
+        self.time_steps = list(time_steps)
+        self.geojson_data = geojson_data
+        self.prefetch = prefetch
+        # None while the layers are being computed: the basins are left blank
+        self.values = anomaly.get_layer(layer, mapping.get_value_column(variable, profile))
+        self.colormap = build_layer_colormap(layer, variable, self.values)
+        self.map = build_base_map(variable, geojson_data, on_select,
+                                  legend=self.colormap._repr_html_())
+        if self.values is None:
+            notice = ('Computing this layer, the map updates when it is ready'
+                      if anomaly.is_building() else 'This layer is not available')
+            self.map.add_control(WidgetControl(
+                widget=HTML(f'<div style="{HOVER_STYLE}">{notice}</div>'),
+                position='topright'))
+        self.layers = {}  # frame index -> GeoJSON, kept so no frame is sent twice
+        self.index = None
+        self.show(0)
+
+    def show(self, index):
+        """
+        Puts the layer of frame `index` on the map and preloads the frames after it.
+
+        Parameters:
+            index (int): Frame (lead time) index
+        """
+        n = len(self.time_steps)
+        index = max(0, min(int(index), n - 1))
+        if self.values is None:
+            self.index = index
+            return
+        # Playback loops, so the frames after the last one are the first ones
+        for i in sorted({(index + k) % n for k in range(min(self.prefetch, n - 1) + 1)}):
+            if i not in self.layers:
+                self.layers[i] = self._build_frame(i)
+
+        frames = {id(layer) for layer in self.layers.values()}
+        others = [layer for layer in self.map.layers if id(layer) not in frames]
+        # Below the outline layer, which keeps hover and click
+        self.map.layers = tuple(others[:1]) + (self.layers[index],) + tuple(others[1:])
+        self.index = index
+
+    def _build_frame(self, index):
+        month = interface.format_date(self.time_steps[index])
+        values = {}
+        if month in self.values.columns:
+            values = self.values[month].dropna().to_dict()
+        colormap = self.colormap
+
+        def style(feature):
+            value = values.get(str(feature['properties'].get('PFAF_ID')))
+            if value is None:
+                return {'fillOpacity': 0}
+            return {'fillColor': colormap.rgb_hex_str(value)}
+
+        return GeoJSON(
+            data=self.geojson_data,
+            style={'color': 'grey', 'weight': 0, 'fillOpacity': FORECAST_OPACITY},
+            style_callback=style,
+            name=f"{self.name} - {self.time_steps[index]}",
+        )
+
+
+def build_layer_colormap(layer, variable, values=None):
+    """
+    Returns the diverging colormap of a derived layer.
+
+    Wetter/above normal is blue, except for temperatures where it is red, like
+    the tercile colorscales in shared.py.
+
+    Parameters:
+        layer (str): One of shared.DERIVED_LAYERS
+        variable (str): Variable name
+        values (DataFrame): Layer values, used to scale layers without a fixed range
+
+    Returns:
+        branca.colormap.LinearColormap: The colormap
+    """
+    from branca.colormap import LinearColormap, linear
+
+    vmin, vmax = shared.DERIVED_LAYERS[layer]['range'] or (-1, 1)
+    if shared.DERIVED_LAYERS[layer]['range'] is None and values is not None:
+        # Symmetric around zero, ignoring the most extreme basins
+        bound = values.abs().stack().quantile(0.95)
+        if bound > 0:
+            vmin, vmax = -bound, bound
+    colors = linear.RdBu_11.colors
+    if variable in shared.TEMPERATURE_VARIABLES:
+        colors = colors[::-1]
+    colormap = LinearColormap(colors, vmin=vmin, vmax=vmax)
+    colormap.caption = shared.DERIVED_LAYERS[layer]['long_name']
+    return colormap
@@ -0,0 +1,143 @@
+"""
+Data retrieval helpers used by the server logic.
+
+Kept free of Shiny reactivity so they can also be driven headlessly
+(see benchmarks/). requests is imported on first use to keep app startup fast.
+Remote data is read through modules/datasource.py, so the last good copy is
+served while the upstream is slow or down.
+"""
+
+import shared
+from modules import datasource, metrics
+
+
+def get_profile(variable, depth):
+    """
+    Returns the soil profile index to request for a variable.
+
+    Parameters:
+        variable (str): Variable name
+        depth (str, int or callable): Value of the depth selector, or the
+            input itself; it is only called for soil variables, so outputs of
+            other variables do not depend on the depth
+
+    Returns:
+        int: Profile index (0 for non-soil variables)
+    """
+    if variable not in shared.SOIL_VARIABLES:
+        return 0
+    return int(depth() if callable(depth) else depth)
+
+
+def get_value_column(variable, profile):
+    """
+    Returns the zonal table column of a variable.
+
+    Parameters:
+        variable (str): Variable name
+        profile (int): Soil profile index
+
+    Returns:
+        str: Column name
+    """
+    return f"{variable}_lvl_{profile}" if variable in shared.SOIL_VARIABLES else variable
+
+
+def load_geojson(timeout=60):
+    """
+    Downloads the level 5 HydroBASINS polygons.
+
+    Parameters:
+        timeout (float): Request timeout in seconds
+
+    Returns:
+        dict: GeoJSON FeatureCollection
+    """
+    import requests
+
+    with metrics.timer('hydroviewer_fetch_seconds', source='geojson'):
+        r = requests.get(shared.hydrobasins_lev05_url, timeout=timeout)
+        r.raise_for_status()
+    with metrics.timer('hydroviewer_parse_seconds', source='geojson'):
+        return r.json()
+
+
+def get_geojson():
+    """
+    Returns the level 5 HydroBASINS polygons, downloading them on first use.
+
+    The simplified polygons of the shared data plane are used when published.
+    Otherwise every call goes through the backend source, so a copy older than
+    its max age is refreshed in the background.
+
+    Returns:
+        dict: GeoJSON FeatureCollection
+    """
+    from modules import dataplane
+
+    plane = dataplane.current()
+    if plane is not None:
+        return plane.geojson()
+    return datasource.BACKEND.get(('geojson', shared.hydrobasins_lev05_url), load_geojson)
+
+
+def fetch_time_steps(variable, profile):
+    """
+    Gets time steps from the tile server metadata endpoint.
+
+    Parameters:
+        variable (str): Variable name
+        profile (int): Soil profile index
+
+    Returns:
+        list: 'YYYY-MM-DD' strings, or None if unavailable
+    """
+    try:
+        return datasource.TILE_SERVER.get(
+            ('time_steps', shared.TILE_SERVER_URL, variable, profile),
+            lambda timeout: _fetch_time_steps(variable, profile, timeout))
+    except Exception:
+        return None
+
+
+def _fetch_time_steps(variable, profile, timeout):
+    import requests
+
+    with metrics.timer('hydroviewer_fetch_seconds', source='time_steps'):
+        res = requests.get(
+            f"{shared.TILE_SERVER_URL}/pyramid/time/{variable}",
+            params={"profile": profile},
+            timeout=timeout,
+        )
+        res.raise_for_status()
+    with metrics.timer('hydroviewer_parse_seconds', source='time_steps'):
+        payload = res.json()
+    time_values = payload.get("time", [])
+    time_values = [t[0:-9]for t in time_values]
+    if not time_values:
+        # Not worth caching; the server has no time axis for this variable
+        raise ValueError(f"No time steps for {variable} (profile {profile})")
+    return time_values
+
+
+def build_tile_url(variable, time_id, category, profile):
+    """
+    Returns the XYZ tile URL template of a forecast layer.
+
+    Parameters:
+        variable (str): Variable name
+        time_id (str or date): Forecast time step
+        category (int): Tercile category index
+        profile (int): Soil profile index
+
+    Returns:
+        str: URL with {z}/{x}/{y} placeholders
+    """
+    if variable in shared.TEMPERATURE_VARIABLES:
+        colormap = shared.colorscales_temp.get(str(category))
+    else:
+        colormap = shared.colorscales.get(str(category))
+
+    return (f'{shared.TILE_SERVER_URL}/tiles/{variable}/{time_id}/{category}/'
+            f'{{z}}/{{x}}/{{y}}.png?colormap={colormap}&profile={profile}'
+            f'&mode=global&vmin=40&vmax=100&release={shared.RELEASE_ID}')
@@ -0,0 +1,295 @@
+"""
+Lightweight request-level instrumentation exported in Prometheus text format.
+
+Metrics are off unless the HYDROVIEWER_METRICS environment variable is set
+(e.g. HYDROVIEWER_METRICS=1). When off, every helper returns immediately and
+`timer()` hands back a shared no-op context manager.
+
+When on, `start_server()` serves them at /metrics on a separate port bound to
+localhost (HYDROVIEWER_METRICS_HOST / HYDROVIEWER_METRICS_PORT, default
+127.0.0.1:9464), never on the public app.
+"""
+
+import contextlib
+import functools
+import os
+import threading
+import time
+import warnings
+
+
+ENABLED = os.environ.get('HYDROVIEWER_METRICS', '').lower() not in ('', '0', 'false', 'no')
+
+# Address of the /metrics server; only reachable from the host by default
+HOST = os.environ.get('HYDROVIEWER_METRICS_HOST', '127.0.0.1')
+PORT = int(os.environ.get('HYDROVIEWER_METRICS_PORT', '9464'))
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HELP = {
+    'hydroviewer_fetch_seconds': 'Time spent fetching remote data',
+    'hydroviewer_parse_seconds': 'Time spent parsing fetched data',
+    'hydroviewer_figure_build_seconds': 'Time spent building Plotly figures',
+    'hydroviewer_widget_render_seconds': 'Time spent building map widgets',
+    'hydroviewer_export_seconds': 'Time spent streaming bulk exports',
+    'hydroviewer_cache_requests_total': 'Cache lookups by result (hit, stale or miss)',
+    'hydroviewer_errors_total': 'Errors caught and shown to the user',
+    'hydroviewer_active_sessions': 'Number of connected Shiny sessions',
+    'hydroviewer_sessions_total': 'Number of Shiny sessions started',
+    'hydroviewer_singleflight_total': 'Deduplicated calls by result (leader or coalesced)',
+    'hydroviewer_render_queue_depth': 'Renders queued or running in a render pool',
+    'hydroviewer_render_shed_total': 'Renders replaced by a fallback because the pool was saturated',
+    'hydroviewer_rollup_missing_basins': 'Level 5 basins missing from the last roll-up build (0 once built)',
+    'hydroviewer_anomaly_missing_basins': 'Level 5 basins missing from the last derived layer build (0 once built)',
+    'hydroviewer_circuit_open': 'Whether the circuit breaker of an upstream source is open (1) or closed (0)',
+}
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> float
+_gauges = {}      # (name, labels) -> float
+_histograms = {}  # (name, labels) -> [bucket counts..., count, sum]
+
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """
+    Increments a counter.
+
+    Parameters:
+        name (str): Metric name
+        value (float): Amount to add
+        **labels: Metric labels
+    """
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def add_gauge(name, value, **labels):
+    """
+    Adds `value` (possibly negative) to a gauge.
+
+    Parameters:
+        name (str): Metric name
+        value (float): Amount to add
+        **labels: Metric labels
+    """
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """
+    Sets a gauge to `value`.
+
+    Parameters:
+        name (str): Metric name
+        value (float): New value
+        **labels: Metric labels
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    """
+    Records a duration in a histogram.
+
+    Parameters:
+        name (str): Metric name
+        seconds (float): Observed duration
+        **labels: Metric labels
+    """
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                hist[i] += 1
+        hist[-2] += 1
+        hist[-1] += seconds
+
+
+def timer(name, **labels):
+    """
+    Returns a context manager recording the wall time of its block.
+
+    Parameters:
+        name (str): Histogram name
+        **labels: Metric labels
+
+    Returns:
+        Context manager
+    """
+    if not ENABLED:
+        return _NULL_TIMER
+    return _Timer(name, labels)
+
+
+def timed(name, **labels):
+    """
+    Decorator recording the wall time of every call of a function.
+
+    Parameters:
+        name (str): Histogram name
+        **labels: Metric labels
+    """
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _Timer(name, labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def render_prometheus():
+    """
+    Renders all metrics, plus process CPU and memory, in Prometheus text format.
+
+    Returns:
+        str: Exposition text
+    """
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+
+    _render_simple(lines, counters, 'counter')
+    _render_simple(lines, gauges, 'gauge')
+
+    for name in sorted({name for name, _ in histograms}):
+        _render_header(lines, name, 'histogram')
+        for (hist_name, labels), hist in sorted(histograms.items()):
+            if hist_name != name:
+                continue
+            for bound, count in zip(BUCKETS, hist):
+                lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {count}')
+            lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {hist[-2]}')
+            lines.append(f'{name}_count{_labels(labels)} {hist[-2]}')
+            lines.append(f'{name}_sum{_labels(labels)} {hist[-1]}')
+
+    cpu = os.times()
+    _render_header(lines, 'process_cpu_seconds_total', 'counter',
+                   'Total user and system CPU time spent in seconds')
+    lines.append(f'process_cpu_seconds_total {cpu.user + cpu.system}')
+    rss = _resident_memory_bytes()
+    if rss is not None:
+        _render_header(lines, 'process_resident_memory_bytes', 'gauge',
+                       'Resident memory size in bytes')
+        lines.append(f'process_resident_memory_bytes {rss}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def start_server(host=HOST, port=PORT):
+    """
+    Serves `render_prometheus()` at /metrics in a background thread.
+
+    Does nothing when metrics are off. If the port is taken (e.g. by another
+    worker process of the same app), a warning is issued instead.
+
+    Parameters:
+        host (str): Interface to bind
+        port (int): Port to bind
+
+    Returns:
+        http.server.ThreadingHTTPServer: The server, or None
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    if not ENABLED:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        warnings.warn(f"Cannot serve metrics on {host}:{port}: {e}", RuntimeWarning)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+def _render_simple(lines, values, kind):
+    for name in sorted({name for name, _ in values}):
+        _render_header(lines, name, kind)
+        for (value_name, labels), value in sorted(values.items()):
+            if value_name == name:
+                lines.append(f'{name}{_labels(labels)} {value}')
+
+
+def _render_header(lines, name, kind, help_text=None):
+    lines.append(f'# HELP {name} {help_text or HELP.get(name, name)}')
+    lines.append(f'# TYPE {name} {kind}')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    body = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels
+    )
+    return '{' + body + '}'
+
+
+def _resident_memory_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
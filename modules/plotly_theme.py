@@ -3,10 +3,6 @@ Brutalist design theme for Plotly charts matching the documentation site.
 This module provides consistent styling across all visualizations.
 """
 
-import plotly.graph_objects as go
-import plotly.express as px
-
-
 # Color scheme - Brutalist monochrome
 COLORS = {
     'primary': '#000000',
@@ -0,0 +1,209 @@
+"""
+Opt-in profiler of the reactive graph, one report per Shiny session.
+
+Off unless HYDROVIEWER_PROFILE names a directory (e.g.
+HYDROVIEWER_PROFILE=profiles). When on, every function wrapped with
+`profiled` records its wall time and its trigger: the watched input whose
+change invalidated it, directly or through the calcs it reads. Watched input
+changes and invalidations are recorded as instant events. When a session
+ends its timeline is written to that directory in Chrome trace format, which
+chrome://tracing, Perfetto and speedscope open directly.
+
+The trigger points at unneeded dependencies, e.g. the map re-rendering with
+trigger `depth_selector` for a variable without depth. A first run has
+trigger `initial`; `null` means something unwatched invalidated the node.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+
+
+PROFILE_DIR = os.environ.get('HYDROVIEWER_PROFILE') or None
+ENABLED = PROFILE_DIR is not None
+
+# session id -> SessionProfile
+_profiles = {}
+_lock = threading.Lock()
+
+
+class SessionProfile:
+    """
+    Timeline of one session.
+
+    Parameters:
+        session_id (str): Shiny session id
+    """
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.started = time.perf_counter()
+        self.events = []
+        self._changing = []    # watched values being set, innermost last
+        self._triggers = {}    # node name -> trigger of its pending invalidation
+
+    def _ts(self, t):
+        return round((t - self.started) * 1e6)
+
+    def _instant(self, name, cat, **args):
+        self.events.append({
+            'name': name, 'cat': cat, 'ph': 'i', 's': 't',
+            'ts': self._ts(time.perf_counter()), 'pid': 1, 'tid': 1, 'args': args,
+        })
+
+    def watch(self, name, value):
+        """
+        Records the changes of a reactive value and attributes the
+        invalidations they cause to it.
+
+        Shiny invalidates dependents synchronously inside the value's setter,
+        so everything invalidated while it runs was invalidated by this value.
+
+        Parameters:
+            name (str): Input (or reactive value) name
+            value (reactive.Value): The value, e.g. `input[name]`
+        """
+        set_value = value._set
+
+        def _set(new_value):
+            self._instant(f'input:{name}', 'input', value=repr(new_value)[:200])
+            self._changing.append(name)
+            try:
+                return set_value(new_value)
+            finally:
+                self._changing.pop()
+
+        value._set = _set
+
+    def invalidated(self, name):
+        """
+        Records the invalidation of a node.
+
+        Parameters:
+            name (str): Node name
+        """
+        trigger = self._changing[-1] if self._changing else None
+        self._triggers[name] = trigger
+        self._instant(f'invalidate:{name}', 'invalidate', trigger=trigger)
+
+    def record(self, name, start, end):
+        """
+        Records one execution of a reactive calc, output or effect.
+
+        Parameters:
+            name (str): Node name
+            start, end (float): time.perf_counter() at start and end
+        """
+        trigger = self._triggers.pop(name, 'initial')
+        self.events.append({
+            'name': name, 'cat': 'reactive', 'ph': 'X',
+            'ts': self._ts(start), 'dur': round((end - start) * 1e6),
+            'pid': 1, 'tid': 1,
+            'args': {'trigger': trigger},
+        })
+
+    def summary(self):
+        """
+        Returns the number of runs, total time and runs per trigger of each node.
+        """
+        nodes = {}
+        for event in self.events:
+            if event['ph'] != 'X':
+                continue
+            node = nodes.setdefault(event['name'], {'runs': 0, 'total_ms': 0.0, 'triggers': {}})
+            node['runs'] += 1
+            node['total_ms'] = round(node['total_ms'] + event['dur'] / 1000, 3)
+            trigger = str(event['args']['trigger'])
+            node['triggers'][trigger] = node['triggers'].get(trigger, 0) + 1
+        return nodes
+
+    def dump(self, directory):
+        """
+        Writes the timeline as a Chrome trace file.
+
+        Parameters:
+            directory (str): Output directory
+
+        Returns:
+            str: Path of the written file
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory, f"session-{time.strftime('%Y%m%d-%H%M%S')}-{self.session_id[:8]}.json")
+        with open(path, 'w') as f:
+            json.dump({
+                'traceEvents': self.events,
+                'displayTimeUnit': 'ms',
+                'otherData': {'session': self.session_id, 'summary': self.summary()},
+            }, f)
+        return path
+
+
+def start_session(session, watched):
+    """
+    Starts profiling a session; its report is written when it ends.
+
+    Must be called from the server function. Does nothing when profiling is off.
+
+    Parameters:
+        session (Session): The Shiny session
+        watched (dict): Name -> reactive.Value (an input or reactive value)
+            whose changes are recorded as triggers
+    """
+    if not ENABLED:
+        return
+
+    profile = SessionProfile(session.id)
+    with _lock:
+        _profiles[session.id] = profile
+
+    for name, value in watched.items():
+        profile.watch(name, value)
+
+    def end():
+        with _lock:
+            _profiles.pop(session.id, None)
+        profile.dump(PROFILE_DIR)
+
+    session.on_ended(end)
+
+
+def profiled(name):
+    """
+    Decorator recording each execution of a reactive calc, output or effect.
+
+    Returns the function unchanged when profiling is off. Put it below the
+    Shiny decorators, but above `reactive.event`, which runs the function
+    isolated from the node's own reactive context.
+
+    Parameters:
+        name (str): Node name in the report
+    """
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profile = _current_profile()
+            if profile is None:
+                return fn(*args, **kwargs)
+            from shiny import reactive
+
+            reactive.get_current_context().on_invalidate(lambda: profile.invalidated(name))
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.record(name, start, time.perf_counter())
+        return wrapper
+    return decorator
+
+
+def _current_profile():
+    from shiny.session import get_current_session
+
+    session = get_current_session()
+    return _profiles.get(session.id) if session is not None else None
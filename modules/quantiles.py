@@ -0,0 +1,134 @@
+"""
+Precomputed ensemble quantiles of the zonal forecasts.
+
+The box plot only needs a handful of statistics per (basin, variable column,
+time step), so they are computed once per basin and kept as a compact float32
+array instead of every ensemble member. Published data plane releases carry
+them precomputed for every basin (see modules/dataplane.py).
+"""
+
+import time
+from typing import NamedTuple
+
+from modules import datasource, dataplane, metrics, zonal
+from modules.singleflight import SingleFlight
+
+
+# Statistics along the last axis of BasinQuantiles.values
+STATS = ('min', 'p5', 'p25', 'p50', 'p75', 'p95', 'max', 'mean')
+
+_PERCENTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+# (release id or None without a data plane, pfaf_id) -> (fetch time of the
+# backend tables they were computed from, BasinQuantiles)
+_quantiles = {}
+
+_fetches = SingleFlight('quantiles')
+
+
+class BasinQuantiles(NamedTuple):
+    """
+    Ensemble statistics of one basin.
+
+    times (list): 'YYYY-MM-DD' time steps
+    columns (list): Zonal table columns
+    values (ndarray): float32 array of shape (len(times), len(columns), len(STATS))
+    climatology (DataFrame): Climatology mean indexed by month
+    """
+    times: list
+    columns: list
+    values: object
+    climatology: object
+
+    def stat(self, column, name):
+        """
+        Returns one statistic of a column at every time step.
+
+        Parameters:
+            column (str): Zonal table column
+            name (str): One of STATS
+
+        Returns:
+            ndarray: One value per time step
+        """
+        return self.values[:, self.columns.index(column), STATS.index(name)]
+
+
+def compute_quantiles(forecast, columns=None):
+    """
+    Computes the ensemble statistics of a forecast table, per time step.
+
+    Parameters:
+        forecast (DataFrame): Zonal forecast table, one row per member and time
+        columns (list): Columns to compute (all value columns by default)
+
+    Returns:
+        tuple: (times, columns, float32 array of shape (times, columns, STATS))
+    """
+    import numpy as np
+
+    if columns is None:
+        columns = [c for c in forecast.select_dtypes('number').columns]
+    frame = forecast.reindex(columns=columns)
+    grouped = frame.groupby(forecast['time'].astype(str).str[:10])
+    stats = ([grouped.min()]
+             + [grouped.quantile(q) for q in _PERCENTILES]
+             + [grouped.max(), grouped.mean()])
+    values = np.stack([s.to_numpy(np.float32) for s in stats], axis=-1)
+    return list(stats[0].index), columns, values
+
+
+def get_quantiles(pfaf_id):
+    """
+    Returns the ensemble statistics of a basin, computing them on first use.
+
+    Parameters:
+        pfaf_id (str or int): Pfafstetter code
+
+    Returns:
+        BasinQuantiles: The statistics
+    """
+    pfaf_id = str(pfaf_id)
+    plane = dataplane.current()
+    key = (plane.release_id if plane is not None else None, pfaf_id)
+    fetched_at, quantiles = _quantiles.get(key, (None, None))
+    # A release never changes; statistics of backend tables are recomputed
+    # once the tables are past the backend's max age (which gets them
+    # refreshed) or have been refreshed since
+    if quantiles is not None and (plane is not None or (
+            fetched_at == zonal.fetched_at(pfaf_id)
+            and time.time() - fetched_at <= datasource.BACKEND.max_age_s)):
+        metrics.inc('hydroviewer_cache_requests_total', cache='quantiles', result='hit')
+        return quantiles
+    metrics.inc('hydroviewer_cache_requests_total', cache='quantiles', result='miss')
+
+    fetched_at = zonal.fetched_at(pfaf_id) if plane is None else None
+    quantiles = _fetches.do(key, lambda: _load_quantiles(pfaf_id, plane))
+    # Statistics of a replaced release are never asked for again
+    for stale in [k for k in list(_quantiles) if k[0] != key[0]]:
+        _quantiles.pop(stale, None)
+    if plane is None and fetched_at is None:
+        # Nothing was cached before this load
+        fetched_at = zonal.fetched_at(pfaf_id)
+    _quantiles[key] = (fetched_at or 0.0, quantiles)
+    return quantiles
+
+
+def clear_cache():
+    """
+    Drops every cached basin.
+    """
+    _quantiles.clear()
+
+
+def _load_quantiles(pfaf_id, plane):
+    if plane is not None and plane.has_quantiles(pfaf_id):
+        _, climatology = plane.tables(pfaf_id)
+        times, values = plane.quantiles(pfaf_id)
+        return BasinQuantiles(times, plane.columns, values, climatology.set_index('month'))
+
+    # Only the statistics are kept; the members are dropped once they are computed
+    forecast, climatology = zonal.get_zonal_tables(pfaf_id, timeout=60, cache=False)
+    with metrics.timer('hydroviewer_parse_seconds', source='quantiles'):
+        times, columns, values = compute_quantiles(forecast)
+    return BasinQuantiles(times, columns, values, climatology.set_index('month'))
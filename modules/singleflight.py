@@ -0,0 +1,179 @@
+"""
+Request coalescing and bounded rendering.
+
+`SingleFlight` makes concurrent callers asking for the same key wait on one
+computation instead of each starting their own. `RenderPool` runs those
+computations on a bounded worker pool and sheds load (calls a cheaper
+fallback) once too many are queued.
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from modules import metrics
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls by key.
+
+    Parameters:
+        name (str): Label used in the metrics
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> Future
+
+    def do(self, key, fn):
+        """
+        Calls `fn()` unless a call for `key` is already running, then waits for it.
+
+        Parameters:
+            key (hashable): Identity of the computation
+            fn (callable): Computation to run
+
+        Returns:
+            The result of `fn()` (exceptions are raised in every waiter)
+        """
+        future, leader = self._claim(key)
+        if not leader:
+            return future.result()
+        self._run(key, future, fn)
+        return future.result()
+
+    def submit(self, key, fn, executor):
+        """
+        Like `do()`, but runs the computation on `executor` and returns a Future.
+
+        Parameters:
+            key (hashable): Identity of the computation
+            fn (callable): Computation to run
+            executor (Executor): Where to run `fn`
+
+        Returns:
+            tuple: (Future, True if this call started the computation)
+        """
+        future, leader = self._claim(key)
+        if leader:
+            executor.submit(self._run, key, future, fn)
+        return future, leader
+
+    def inflight(self, key):
+        """
+        Returns True while a computation for `key` is running.
+        """
+        return key in self._inflight
+
+    def _claim(self, key):
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                metrics.inc('hydroviewer_singleflight_total', flight=self.name, result='coalesced')
+                return future, False
+            future = self._inflight[key] = Future()
+        metrics.inc('hydroviewer_singleflight_total', flight=self.name, result='leader')
+        return future, True
+
+    def _run(self, key, future, fn):
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
+class RenderPool:
+    """
+    Bounded worker pool with single-flight submission and load shedding.
+
+    Parameters:
+        name (str): Label used in the metrics
+        max_workers (int): Number of render threads
+        max_queue (int): Queued renders above which new work is shed
+    """
+
+    def __init__(self, name, max_workers=4, max_queue=64):
+        self.name = name
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix=f'{name}-render')
+        self._flight = SingleFlight(name)
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def queue_depth(self):
+        return self._pending
+
+    def render(self, key, fn, shed=None, timeout=None):
+        """
+        Returns `fn()` for `key`, sharing the render with concurrent callers.
+
+        When `max_queue` renders are already pending and nobody is rendering
+        `key` yet, `shed()` is returned instead (if given). Callers joining an
+        in-flight render are never shed.
+
+        Parameters:
+            key (hashable): Identity of the render (e.g. the tile cache key)
+            fn (callable): Render function
+            shed (callable): Cheaper fallback used when the pool is saturated
+            timeout (float): Seconds to wait for the render
+
+        Returns:
+            The render result, or the fallback result
+        """
+        # Checked and reserved together, so concurrent callers cannot all
+        # slip in under the limit
+        with self._lock:
+            shedding = (shed is not None and self._pending >= self.max_queue
+                        and not self._flight.inflight(key))
+            if not shedding:
+                self._pending += 1
+            pending = self._pending
+        if shedding:
+            metrics.inc('hydroviewer_render_shed_total', pool=self.name)
+            return shed()
+        metrics.set_gauge('hydroviewer_render_queue_depth', pending, pool=self.name)
+
+        def tracked():
+            try:
+                return fn()
+            finally:
+                self._add_pending(-1)
+
+        future, leader = self._flight.submit(key, tracked, self._executor)
+        if not leader:
+            self._add_pending(-1)
+        return future.result(timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _add_pending(self, delta):
+        with self._lock:
+            self._pending += delta
+            pending = self._pending
+        metrics.set_gauge('hydroviewer_render_queue_depth', pending, pool=self.name)
+
+
+def overzoom_parent(z, x, y, levels=1):
+    """
+    Returns the lower-zoom tile containing tile (z, x, y), plus the quadrant offset.
+
+    A saturated tile backend can serve the parent tile scaled up instead of
+    rendering (z, x, y). Works for XYZ and TMS numbering alike.
+
+    Parameters:
+        z, x, y (int): Tile coordinates
+        levels (int): Number of zoom levels to go up
+
+    Returns:
+        tuple: ((z, x, y) of the parent, (dx, dy) position of the child inside it)
+    """
+    levels = min(levels, z)
+    scale = 2 ** levels
+    return (z - levels, x // scale, y // scale), (x % scale, y % scale)
@@ -0,0 +1,365 @@
+"""
+Zonal statistics cache and hierarchical (Pfafstetter) basin roll-ups.
+
+Level 5 zonal tables are read from the remote backend one basin at a time,
+through the backend source (modules/datasource.py), which caches them and
+refreshes copies past their max age. Levels 1-4 are derived from them once
+per process: every level 5 table is loaded, then the ensemble members are
+combined with area weights in a single grouped pass per level. Only the
+results are cached (level 5 members are dropped once aggregated), so looking
+up a coarse basin costs a dict lookup. The roll-ups are only built from a
+complete set of level 5 basins; while any is missing they stay unavailable
+and the build is retried.
+
+When a release has been published to the shared data plane (see
+modules/dataplane.py), tables of every level are served from it instead, so
+they follow the live release and nothing is fetched or cached per process.
+
+pandas and requests are imported on first use to keep app startup fast.
+"""
+
+import io
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import shared
+from modules import datasource, metrics
+
+
+# pfaf_id (str) of a level 1-4 basin -> (forecast table, climatology table)
+_tables = {}
+
+# Pfafstetter level -> GeoJSON dict of the dissolved basins at that level
+_basin_geojson = {}
+
+# Roll-up builds before giving up, and the base delay between them (grows linearly)
+ROLLUP_ATTEMPTS = 5
+ROLLUP_RETRY_S = 60
+
+_rollup_lock = threading.Lock()
+_rollups_ready = threading.Event()
+_rollup_thread = None
+# Only guards _rollup_thread: the build holds _rollup_lock for minutes and
+# start_rollup_build is called from render functions on the event loop
+_rollup_thread_lock = threading.Lock()
+
+
+def pfaf_level(pfaf_id):
+    """
+    Returns the Pfafstetter level of a basin code (one digit per level).
+
+    Parameters:
+        pfaf_id (str or int): Pfafstetter code
+
+    Returns:
+        int: Level of the code
+    """
+    return len(str(pfaf_id))
+
+
+def level_for_zoom(zoom):
+    """
+    Returns the Pfafstetter level to display at a given map zoom.
+
+    Parameters:
+        zoom (int or float): Current map zoom
+
+    Returns:
+        int: Pfafstetter level
+    """
+    for min_zoom, level in shared.PFAF_ZOOM_LEVELS:
+        if zoom >= min_zoom:
+            return level
+    return shared.PFAF_ZOOM_LEVELS[-1][1]
+
+
+def get_zonal_tables(pfaf_id, timeout=None, cache=True, use_plane=True):
+    """
+    Returns the forecast and climatology tables of a basin at any level.
+
+    Level 5 basins are fetched on first use. Coarser basins are served from the
+    roll-ups, waiting for them to finish building if needed.
+
+    Parameters:
+        pfaf_id (str or int): Pfafstetter code
+        timeout (float): Seconds to wait for the roll-ups (None waits forever)
+        cache (bool): Keep a level 5 basin in memory (not only on disk)
+        use_plane (bool): Serve the basin from the data plane if published
+            (the publisher reads the backend instead)
+
+    Returns:
+        tuple: (forecast DataFrame, climatology DataFrame)
+    """
+    pfaf_id = str(pfaf_id)
+    plane = _data_plane() if use_plane else None
+    if plane is not None and plane.has_basin(pfaf_id):
+        metrics.inc('hydroviewer_cache_requests_total', cache='dataplane', result='hit')
+        return plane.tables(pfaf_id)
+
+    if pfaf_level(pfaf_id) >= shared.PFAF_BASE_LEVEL:
+        # Cached by the backend source, which refreshes copies past their max age
+        return _read_basin_tables(pfaf_id, memory=cache)
+
+    tables = _tables.get(pfaf_id)
+    if tables is not None:
+        metrics.inc('hydroviewer_cache_requests_total', cache='zonal', result='hit')
+        return tables
+    metrics.inc('hydroviewer_cache_requests_total', cache='zonal', result='miss')
+    _rollups_ready.wait(timeout)
+    if pfaf_id not in _tables:
+        raise KeyError(f"No aggregated zonal statistics for basin {pfaf_id}")
+    return _tables[pfaf_id]
+
+
+def fetched_at(pfaf_id):
+    """
+    Returns when the cached backend copy of a level 5 basin was fetched.
+
+    Parameters:
+        pfaf_id (str or int): Pfafstetter code
+
+    Returns:
+        float: Epoch seconds, or None if nothing is cached
+    """
+    return datasource.BACKEND.fetched_at(_basin_key(str(pfaf_id)))
+
+
+def clear_cache():
+    """
+    Drops every cached zonal table and roll-up.
+    """
+    with _rollup_lock:
+        _tables.clear()
+        _basin_geojson.clear()
+        _rollups_ready.clear()
+
+
+def iter_cached_tables():
+    """
+    Returns the cached (pfaf_id, tables) pairs, e.g. to publish them.
+
+    Returns:
+        list: (pfaf_id, (forecast DataFrame, climatology DataFrame)) tuples
+    """
+    return list(_tables.items())
+
+
+def get_basin_geojson(geojson_data, level):
+    """
+    Returns the basin polygons to display at a Pfafstetter level.
+
+    Parameters:
+        geojson_data (dict): Level 5 basins GeoJSON
+        level (int): Pfafstetter level
+
+    Returns:
+        dict: GeoJSON of the basins, or None while the roll-ups are building
+    """
+    if level >= shared.PFAF_BASE_LEVEL:
+        return geojson_data
+    return _basin_geojson.get(level)
+
+
+def start_rollup_build(geojson_data):
+    """
+    Builds the level 1-4 roll-ups in a background thread, once per process.
+
+    While any level 5 basin cannot be loaded the roll-ups stay unavailable
+    and the build is retried, up to ROLLUP_ATTEMPTS times.
+
+    Parameters:
+        geojson_data (dict): Level 5 basins GeoJSON
+
+    Returns:
+        threading.Thread: The build thread
+    """
+    global _rollup_thread
+    with _rollup_thread_lock:
+        if _rollup_thread is None:
+            _rollup_thread = threading.Thread(
+                target=_build_rollups_with_retries, args=(geojson_data,), daemon=True)
+            _rollup_thread.start()
+    return _rollup_thread
+
+
+def build_rollups(geojson_data, max_workers=8, use_plane=True):
+    """
+    Builds the level 1-4 zonal tables and basin polygons from level 5.
+
+    Every level 5 table is loaded (but not cached), then each coarser level
+    is computed as the area-weighted mean of its children, per time step and
+    ensemble member (forecast) or per month (climatology). With a published
+    data plane only the polygons are built.
+
+    If any level 5 basin fails to load nothing is built and the roll-ups are
+    not marked ready; the caller retries.
+
+    Parameters:
+        geojson_data (dict): Level 5 basins GeoJSON
+        max_workers (int): Number of concurrent level 5 downloads
+        use_plane (bool): Rely on the published data plane for the tables
+            (the publisher passes False to build them from the backend)
+
+    Returns:
+        list: PFAF_IDs of the level 5 basins that could not be loaded
+    """
+    import pandas as pd
+
+    with _rollup_lock, metrics.timer('hydroviewer_parse_seconds', source='rollups'):
+        if _rollups_ready.is_set():
+            return []
+        areas = {
+            str(feature['properties']['PFAF_ID']):
+                float(feature['properties'].get('SUB_AREA') or 1.0)
+            for feature in geojson_data['features']
+        }
+
+        # The published release holds levels 1-4 already
+        if use_plane and _data_plane() is not None:
+            areas = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            loaded = list(pool.map(
+                lambda pfaf_id: _try_get_zonal_tables(pfaf_id, use_plane), areas))
+        missing = [pfaf_id for pfaf_id, tables in zip(areas, loaded) if tables is None]
+        metrics.set_gauge('hydroviewer_rollup_missing_basins', len(missing))
+        if missing:
+            # A mean over a subset of the children would be silently wrong
+            return missing
+
+        forecast, climatology = [], []
+        for pfaf_id, (forecast_tab, climatology_tab) in zip(areas, loaded):
+            forecast_tab = forecast_tab.assign(
+                PFAF_ID=pfaf_id,
+                member=forecast_tab.groupby('time').cumcount(),
+            )
+            forecast.append(forecast_tab)
+            climatology.append(climatology_tab.assign(PFAF_ID=pfaf_id))
+
+        if forecast:
+            forecast = pd.concat(forecast, ignore_index=True)
+            climatology = pd.concat(climatology, ignore_index=True)
+            weights = pd.Series(areas)
+            for level in range(1, shared.PFAF_BASE_LEVEL):
+                forecast_lvl = _area_weighted_mean(
+                    forecast, weights, level, ['time', 'member'])
+                climatology_lvl = _area_weighted_mean(
+                    climatology, weights, level, ['month'])
+                for pfaf_id, forecast_tab in forecast_lvl.groupby('PFAF_ID'):
+                    climatology_tab = climatology_lvl[
+                        climatology_lvl['PFAF_ID'] == pfaf_id]
+                    _tables[pfaf_id] = (
+                        forecast_tab.drop(columns=['PFAF_ID', 'member'])
+                                    .reset_index(drop=True),
+                        climatology_tab.drop(columns=['PFAF_ID'])
+                                       .reset_index(drop=True),
+                    )
+
+        for level in range(1, shared.PFAF_BASE_LEVEL):
+            _basin_geojson[level] = _dissolve_basins(geojson_data, level)
+        _rollups_ready.set()
+        return []
+
+
+def _build_rollups_with_retries(geojson_data):
+    for attempt in range(1, ROLLUP_ATTEMPTS + 1):
+        try:
+            missing = build_rollups(geojson_data)
+        except Exception as e:
+            missing = None
+            warnings.warn(f"Building the basin roll-ups failed: {e!r}", RuntimeWarning)
+            metrics.inc('hydroviewer_errors_total', source='rollups')
+        if missing == []:
+            return
+        if missing:
+            warnings.warn(
+                f"{len(missing)} of {len(geojson_data['features'])} basins could not be "
+                f"loaded (e.g. {', '.join(missing[:5])}); roll-ups are unavailable "
+                f"(attempt {attempt} of {ROLLUP_ATTEMPTS})", RuntimeWarning)
+        if attempt < ROLLUP_ATTEMPTS:
+            time.sleep(ROLLUP_RETRY_S * attempt)
+
+
+def _data_plane():
+    from modules import dataplane
+
+    return dataplane.current()
+
+
+def _read_basin_tables(pfaf_id, memory=True):
+    """
+    Reads the forecast and climatology tables of a level 5 basin.
+
+    The last good copy is served while the backend is slow or down; with
+    `memory` it is also kept in memory.
+    """
+    def load(timeout):
+        return (_read_csv(shared.ZONAL_FORECAST_PATH + pfaf_id + ".csv", 'zonal_forecast', timeout),
+                _read_csv(shared.ZONAL_CLIM_PATH + pfaf_id + ".csv", 'zonal_climatology', timeout))
+
+    return datasource.BACKEND.get(_basin_key(pfaf_id), load, memory=memory)
+
+
+def _basin_key(pfaf_id):
+    return ('zonal', shared.BACKEND_DIR, pfaf_id)
+
+
+def _read_csv(url, source, timeout=30):
+    import pandas as pd
+    import requests
+
+    with metrics.timer('hydroviewer_fetch_seconds', source=source):
+        res = requests.get(url, timeout=timeout)
+        res.raise_for_status()
+    with metrics.timer('hydroviewer_parse_seconds', source=source):
+        return pd.read_csv(io.StringIO(res.text))
+
+
+def _try_get_zonal_tables(pfaf_id, use_plane=True):
+    try:
+        return get_zonal_tables(pfaf_id, cache=False, use_plane=use_plane)
+    except Exception:
+        metrics.inc('hydroviewer_errors_total', source='rollups')
+        return None
+
+
+def _area_weighted_mean(table, weights, level, keys):
+    """
+    Combines level 5 rows into their level `level` ancestors.
+
+    Parameters:
+        table (DataFrame): Level 5 rows with a PFAF_ID column and `keys`
+        weights (Series): Basin area indexed by level 5 PFAF_ID
+        level (int): Target Pfafstetter level
+        keys (list): Columns identifying a row within a basin
+
+    Returns:
+        DataFrame: One row per (ancestor PFAF_ID, *keys)
+    """
+    value_cols = [
+        c for c in table.select_dtypes('number').columns if c not in keys
+    ]
+    values = table[value_cols]
+    w = table['PFAF_ID'].map(weights)
+    weighted = values.mul(w, axis=0)
+    # Missing values must not count towards the weight total
+    total_weight = values.notna().mul(w, axis=0)
+
+    groups = [table['PFAF_ID'].str[:level].rename('PFAF_ID')] + [table[k] for k in keys]
+    result = (weighted.groupby(groups).sum()
+              / total_weight.groupby(groups).sum().replace(0, float('nan')))
+    return result.reset_index()
+
+
+def _dissolve_basins(geojson_data, level):
+    """
+    Merges level 5 polygons into their level `level` ancestors.
+    """
+    import geopandas as gpd
+
+    basins = gpd.GeoDataFrame.from_features(geojson_data['features'])
+    basins['PFAF_ID'] = basins['PFAF_ID'].astype(str).str[:level]
+    dissolved = basins[['PFAF_ID', 'geometry']].dissolve(by='PFAF_ID').reset_index()
+    return dissolved.__geo_interface__
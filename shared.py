@@ -1,3 +1,5 @@
+import os
+
 # list of variables in the app
 CLIM_VAR_META = VARIABLE_META = {
     "Rainf_tavg": {
@@ -34,6 +36,12 @@ CLIM_VAR_META = VARIABLE_META = {
     },
 }
 
+# variables with a soil profile (depth) dimension
+SOIL_VARIABLES = ["SoilTemp_inst", "SoilMoist_inst"]
+
+# variables displayed with the inverted (temperature) colorscales
+TEMPERATURE_VARIABLES = ['Tair_f_tavg', 'SoilTemp_inst']
+
 # list of profile indices and corresponding meaning
 SOIL_VAR_PROFILE = {
     0: '0-10cm', 
@@ -49,6 +57,26 @@ FORECAST_PCATE = {
     2:'Above normal'
 }
 
+# derived layers computed from the zonal tables (see modules/anomaly.py)
+DERIVED_LAYERS = {
+    'median_anomaly': {
+        'long_name': 'Ensemble median anomaly',
+        'range': None,  # symmetric, from the data
+    },
+    'standardized_anomaly': {
+        'long_name': 'Standardized anomaly',
+        'range': (-2, 2),
+    },
+    'exceedance_probability': {
+        'long_name': 'Probability above climatology',
+        'range': (0, 1),
+    },
+}
+
+# layers offered on the map
+MAP_LAYERS = {'probability': 'Tercile probability',
+              **{k: DERIVED_LAYERS[k]['long_name'] for k in DERIVED_LAYERS}}
+
 # Legacy continuous colorscale names (for backward compatibility)
 colorscales = {
     '0': 'Reds',      # Below normal
@@ -64,7 +92,9 @@ colorscales_temp = {
 }
 
 # general path to remote backend data
-BACKEND_DIR = 'https://raw.githubusercontent.com/Amazon-ARCHive/amazon_hydroviewer_backend/refs/heads/main/'
+BACKEND_DIR = os.environ.get(
+    'HYDROVIEWER_BACKEND_DIR',
+    'https://raw.githubusercontent.com/Amazon-ARCHive/amazon_hydroviewer_backend/refs/heads/main/')
 
 # probabilistic_data_path = REMOTE_REPO + 'get_ldas_probabilistic_output/prob_2024_12_31_tercile_probability_max_'
 # pyramid_file = PYRAMID_DIR / f"prob_2024_dec_tercile_probability_max_{variable}_lvl_{profile}_subsampled.pkl"
@@ -75,7 +105,27 @@ ZONAL_FORECAST_PATH = BACKEND_DIR + 'get_zonal_averages_forecast_csv/zonal_forec
 ZONAL_CLIM_PATH = BACKEND_DIR + 'get_zonal_averages_climatology_csv/zonal_climatology_pfaf_'
 
 # path to geojson file @remote location for visualization
-hydrobasins_lev05_url = 'https://raw.githubusercontent.com/blackteacatsu/spring_2024_envs_research_amazon_ldas/main/resources/hybas_sa_lev05_areaofstudy.geojson'
+hydrobasins_lev05_url = os.environ.get(
+    'HYDROVIEWER_GEOJSON_URL',
+    'https://raw.githubusercontent.com/blackteacatsu/spring_2024_envs_research_amazon_ldas/main/resources/hybas_sa_lev05_areaofstudy.geojson')
+
+# Release id of the published data, part of tile and asset URLs so browsers can cache them
+# for good; 'dev' disables long-lived caching
+RELEASE_ID = os.environ.get('HYDROVIEWER_RELEASE', 'dev')
+
+# Shared local tile server URL
+TILE_SERVER_URL = os.environ.get('HYDROVIEWER_TILE_SERVER_URL', "http://localhost:4000")
+#TILE_SERVER_URL = "https://amazonhydroviewer.onrender.com"
+
+# Pfafstetter level of the basins we have zonal data for; coarser levels are rolled up from it
+PFAF_BASE_LEVEL = 5
+
+# (minimum map zoom, Pfafstetter level) pairs, checked in order, for hover and click on the map
+PFAF_ZOOM_LEVELS = [(4, 5), (3, 4), (2, 3), (0, 2)]
+
+# Lead-time playback: milliseconds per frame and number of upcoming frames preloaded on the map
+PLAYBACK_INTERVAL_MS = 400
+PLAYBACK_PREFETCH = 2
 
 # Pyramid configuration
 USE_PYRAMID = True  # Set to False to use original method
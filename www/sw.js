@@ -0,0 +1,80 @@
+// Service worker of the Amazon HydroViewer.
+//
+// Registered from the page head with the release id (sw.js?release=<id>).
+// Tiles and static assets whose URL carries that release id never change, so
+// they are served cache-first; a new release starts a new cache and drops
+// the old one.
+
+const RELEASE = new URL(self.location).searchParams.get('release') || 'dev';
+const CACHE = `hydroviewer-${RELEASE}`;
+
+// Fetched on install so the first map render needs no network for them
+const PRECACHE = [
+  `static/probability_legend_default.png?v=${RELEASE}`,
+  `static/probability_legend_temp.png?v=${RELEASE}`,
+];
+
+// Most recently cached tiles kept per release
+const MAX_ENTRIES = 3000;
+
+self.addEventListener('install', (event) => {
+  event.waitUntil(
+    caches.open(CACHE)
+      .then((cache) => cache.addAll(PRECACHE))
+      .then(() => self.skipWaiting())
+  );
+});
+
+self.addEventListener('activate', (event) => {
+  event.waitUntil(
+    caches.keys()
+      .then((names) => Promise.all(
+        names.filter((name) => name.startsWith('hydroviewer-') && name !== CACHE)
+             .map((name) => caches.delete(name))))
+      .then(() => self.clients.claim())
+  );
+});
+
+function isVersioned(url) {
+  return url.searchParams.get('v') === RELEASE || url.searchParams.get('release') === RELEASE;
+}
+
+async function trim(cache) {
+  const keys = await cache.keys();
+  // Keys come back in insertion order: drop the oldest
+  await Promise.all(keys.slice(0, Math.max(0, keys.length - MAX_ENTRIES))
+                        .map((key) => cache.delete(key)));
+}
+
+async function cacheFirst(event) {
+  const cache = await caches.open(CACHE);
+  const cached = await cache.match(event.request.url);
+  if (cached) {
+    return cached;
+  }
+  // Map tiles are requested without CORS and would come back opaque: their
+  // status is unknown, so an error could be cached for the whole release,
+  // and each one counts for several megabytes of quota. Fetch them with CORS
+  // instead (the tile server sends Access-Control-Allow-Origin).
+  let response;
+  try {
+    response = await fetch(event.request.url, {mode: 'cors', credentials: 'omit'});
+  } catch (error) {
+    // No CORS headers: serve the page's own request, uncached
+    return fetch(event.request);
+  }
+  if (response.ok) {
+    event.waitUntil(cache.put(event.request.url, response.clone()).then(() => trim(cache)));
+  }
+  return response;
+}
+
+self.addEventListener('fetch', (event) => {
+  if (event.request.method !== 'GET') {
+    return;
+  }
+  const url = new URL(event.request.url);
+  if (isVersioned(url)) {
+    event.respondWith(cacheFirst(event));
+  }
+});